@@ -1,4 +1,4 @@
-import socket, time
+import socket, time, zlib
 
 protover = 3
 client = 'nzbtoanidb'
@@ -28,7 +28,139 @@ acode = (
 	)
 
 info = fcode + acode
-#info = dict([(info[i], 1 << i) for i in range(len(info)) if info[i]])
+
+# The server cuts replies at this size; compressed replies inflate beyond it.
+max_reply = 1400
+
+# FILE reply fields in the order the server sends them: (name, mask bit, type).
+ffields = (
+	('aid', 0x4000000000, int),
+	('eid', 0x2000000000, int),
+	('gid', 0x1000000000, int),
+	('lid', 0x0800000000, int),
+	('otherep', 0x0400000000, str),
+	('depr', 0x0200000000, int),
+	('state', 0x0100000000, int),
+	('size', 0x0080000000, int),
+	('ed2k', 0x0040000000, str),
+	('md5', 0x0020000000, str),
+	('sha1', 0x0010000000, str),
+	('crc32', 0x0008000000, str),
+	('vcdepth', 0x0002000000, str),
+	('quality', 0x0000800000, str),
+	('source', 0x0000400000, str),
+	('acodec', 0x0000200000, str),
+	('abitrate', 0x0000100000, str),
+	('vcodec', 0x0000080000, str),
+	('vbitrate', 0x0000040000, int),
+	('vres', 0x0000020000, str),
+	('filetype', 0x0000010000, str),
+	('dublang', 0x0000008000, str),
+	('sublang', 0x0000004000, str),
+	('length', 0x0000002000, int),
+	('description', 0x0000001000, str),
+	('airdate', 0x0000000800, int),
+	('anifilename', 0x0000000100, str),
+	('mystate', 0x0000000080, int),
+	('myfilestate', 0x0000000040, int),
+	('viewed', 0x0000000020, int),
+	('viewdate', 0x0000000010, int),
+	('storage', 0x0000000008, str),
+	('mysource', 0x0000000004, str),
+	('myother', 0x0000000002, str),
+	)
+
+afields = (
+	('eptotal', 0x80000000, int),
+	('eplast', 0x40000000, int),
+	('year', 0x20000000, str),
+	('type', 0x10000000, str),
+	('related', 0x08000000, str),
+	('relatedtype', 0x04000000, str),
+	('category', 0x02000000, str),
+	('romaji', 0x00800000, str),
+	('kanji', 0x00400000, str),
+	('english', 0x00200000, str),
+	('othername', 0x00100000, str),
+	('shortname', 0x00080000, str),
+	('synonym', 0x00040000, str),
+	('epno', 0x00008000, str),
+	('epname', 0x00004000, str),
+	('epromaji', 0x00002000, str),
+	('epkanji', 0x00001000, str),
+	('eprating', 0x00000800, int),
+	('epvotes', 0x00000400, int),
+	('gname', 0x00000080, str),
+	('gtag', 0x00000040, str),
+	('updated', 0x00000001, int),
+	)
+
+def masks(fields):
+	# Builds fmask/amask for the wanted fields, returns them with the reply layout.
+	fields = set(fields)
+	fmask = amask = 0
+	layout = [('fid', int)]
+	for name, bit, kind in ffields:
+		if name in fields:
+			fmask |= bit
+			layout.append((name, kind))
+	for name, bit, kind in afields:
+		if name in fields:
+			amask |= bit
+			layout.append((name, kind))
+	unknown = fields.difference(f[0] for f in ffields + afields)
+	if unknown:
+		raise ValueError('unknown file fields: ' + ', '.join(sorted(unknown)))
+	return '{0:010X}'.format(fmask), '{0:08X}'.format(amask), tuple(layout)
+
+class FileInfo:
+	__slots__ = ('fid',) + tuple(f[0] for f in ffields + afields)
+
+	def __init__(self, layout, values):
+		for name in self.__slots__:
+			setattr(self, name, None)
+		for (name, kind), value in zip(layout, values):
+			if kind is int:
+				try:
+					value = int(value)
+				except ValueError:
+					value = None
+			setattr(self, name, value)
+
+	# state bits
+	@property
+	def crcok(self):
+		return bool(self.state & 0x01)
+
+	@property
+	def crcerr(self):
+		return bool(self.state & 0x02)
+
+	@property
+	def version(self):
+		v = self.state & 0x3c
+		return {4: 2, 8: 3, 16: 4, 32: 5}.get(v, 1)
+
+	@property
+	def censored(self):
+		return bool(self.state & 0x80)
+
+	@property
+	def uncensored(self):
+		return bool(self.state & 0x40)
+
+	@property
+	def episodes(self):
+		# '05' -> ('', 5, 5), 'S1' -> ('S', 1, 1), '01-03' -> ('', 1, 3)
+		first, sep, last = self.epno.partition('-')
+		prefix = first.rstrip('0123456789')
+		try:
+			return prefix, int(first[len(prefix):]), int((last or first).lstrip(prefix))
+		except ValueError:
+			return prefix, None, None
+
+	def __repr__(self):
+		return 'FileInfo({0})'.format(', '.join('{0}={1!r}'.format(n, getattr(self, n)) for n in self.__slots__ if getattr(self, n) is not None))
 
 LOGIN_ACCEPTED                           = 200
 LOGIN_ACCEPTED_NEW_VERSION               = 201
@@ -195,6 +327,15 @@ class AniDBUserError(AniDBLoginError):
 class AniDBReplyError(AniDBError):
 	pass
 
+class AniDBUnavailable(AniDBReplyError):
+	# Banned or a server side outage, the request may be sent again later.
+	def __init__(self, code, text):
+		AniDBReplyError.__init__(self, code, text)
+		self.code = code
+
+# Replies that say nothing about the request itself.
+unavailable = (BANNED, ANIDB_OUT_OF_SERVICE, SERVER_BUSY, TIMEOUT_DELAY_AND_RESUBMIT)
+
 class AniDBUnknownFile(AniDBError):
 	pass
 
@@ -208,50 +349,164 @@ class AniDBUnknownDescription(AniDBError):
 	pass
 
 class AniDB:
-	def __init__(self, username, password, localport = 1234, server = ('api.anidb.info', 9000)):
+	def __init__(self, username, password, localport = 1234, server = ('api.anidb.info', 9000), compress = False, cache = None, cache_age = 0, mylist = None, mylist_age = 0):
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 		self.sock.bind(('0.0.0.0', localport))
 		self.sock.settimeout(10)
 		self.username = username
 		self.password = password
 		self.server = server
+		self.compress = compress
+		self.cache = cache
+		self.cache_age = cache_age
+		self.mylist = mylist
+		self.mylist_age = mylist_age
+		self.truncated = False
 		self.session = ''
 		self.lasttime = 0
+		self.wait_time = 0.0
+		self.rtt_time = 0.0
 	
 	def __del__(self):
 		self.logout()
 		self.sock.close()
 	
+	def login_msg(self):
+		print('Logged in as user: {0}'.format(self.username))
+	
 	def newver_msg(self):
 		print('New version available.')
 	
 	def retry_msg(self):
 		print('Connection timed out, retrying.')
 	
+	def truncated_msg(self):
+		print('Reply truncated, switching to compressed replies.')
+	
+	def receive(self):
+		# Returns the reply text and whether the server cut it off.
+		data = self.sock.recv(65536)
+		if data[:2] == b'\x00\x00':
+			for wbits in (zlib.MAX_WBITS, -zlib.MAX_WBITS):
+				inflate = zlib.decompressobj(wbits)
+				try:
+					text = inflate.decompress(data[2:])
+				except zlib.error:
+					continue
+				return text.decode(errors = 'ignore'), not inflate.eof
+			raise AniDBReplyError(0, 'invalid compressed reply')
+		truncated = len(data) >= max_reply and not data.endswith(b'\n')
+		return data.decode(errors = 'ignore' if truncated else 'strict'), truncated
+	
+	def send(self, cmd, args):
+		data = '{0} {1}\n'.format(cmd, '&'.join(['{0}={1}'.format(*a) for a in args.items()]))
+		t = time.time()
+		if t < self.lasttime + 2:
+			time.sleep(self.lasttime + 2 - t)
+		self.lasttime = time.time()
+		self.wait_time += self.lasttime - t
+		self.sock.sendto(data.encode(), 0, self.server)
+	
+	def parse(self, data, truncated):
+		# Returns tag, code, text and the reply fields; untagged replies get tag None.
+		data = data.split('\n')
+		first = data[0].split(' ', 2)
+		tag = None
+		if not first[0].isdigit():
+			tag = first.pop(0)
+		code, text = int(first[0]), ' '.join(first[1:])
+		if truncated:
+			# Keep what arrived, minus the field that was cut.
+			data = [line.split('|') for line in data[1:]]
+			if data:
+				data[-1].pop()
+		else:
+			data = [line.split('|') for line in data[1:-1]]
+		return tag, code, text, data
+	
 	def execute(self, cmd, args = None, retry = False):
 		if not args:
 			args = {}
+		# The session is opened by the first request that needs one, a run
+		# served from the caches never logs in (nor out).
+		if 's' in args and not self.session and cmd != 'LOGOUT':
+			self.auth(retry)
+			args['s'] = self.session
 		while 1:
-			data = '{0} {1}\n'.format(cmd, '&'.join(['{0}={1}'.format(*a) for a in args.items()]))
-			t = time.time()
-			if t < self.lasttime + 2:
-				time.sleep(self.lasttime + 2 - t)
-			self.lasttime = time.time()
-			self.sock.sendto(data.encode(), 0, self.server)
+			self.send(cmd, args)
 			try:
-				data = self.sock.recv(8192).decode().split('\n')
+				data, self.truncated = self.receive()
+				# Late replies to pipelined requests carry a tag, skip them.
+				while not data[:3].isdigit():
+					data, self.truncated = self.receive()
 			except socket.timeout:
+				self.rtt_time += time.time() - self.lasttime
 				if retry:
 					self.retry_msg()
 				else:
 					raise AniDBTimeout()
 			else:
+				self.rtt_time += time.time() - self.lasttime
+				# A long reply is worth another round trip with a compressed session.
+				if self.truncated and not self.compress and 's' in args and cmd not in ('AUTH', 'LOGOUT'):
+					self.truncated_msg()
+					self.compress = True
+					self.auth()
+					args['s'] = self.session
+					continue
 				break
-		code, text = data[0].split(' ', 1)
-		data = [line.split('|') for line in data[1:-1]]
-		code = int(code)
+		tag, code, text, data = self.parse(data, self.truncated)
+		if code in unavailable:
+			if code == BANNED:
+				# Every request during a ban prolongs it, LOGOUT included.
+				self.session = ''
+			raise AniDBUnavailable(code, text)
 		return code, text, data
 	
+	def execute_many(self, cmd, arglist, retry = False):
+		# Sends the commands one throttle slot apart without waiting for the
+		# replies in between and matches the replies by tag, in any order.
+		if any('s' in args for args in arglist) and not self.session:
+			self.auth(retry)
+			arglist = [dict(args, s = self.session) if 's' in args else args for args in arglist]
+		pending = {}
+		for n, args in enumerate(arglist):
+			pending['p{0}'.format(n)] = dict(args, tag = 'p{0}'.format(n))
+		queue = list(pending)
+		results = {}
+		timeout = self.sock.gettimeout()
+		try:
+			while pending:
+				if queue:
+					tag = queue.pop(0)
+					if tag in pending:
+						self.send(cmd, pending[tag])
+				# Listen until the next slot is free, or the full timeout once all is sent.
+				deadline = self.lasttime + (2 if queue else timeout)
+				while pending and time.time() < deadline:
+					self.sock.settimeout(max(deadline - time.time(), 0.001))
+					try:
+						data, truncated = self.receive()
+					except socket.timeout:
+						break
+					self.rtt_time += time.time() - self.lasttime
+					tag, code, text, data = self.parse(data, truncated)
+					if code in unavailable:
+						if code == BANNED:
+							self.session = ''
+						raise AniDBUnavailable(code, text)
+					if tag in pending:
+						del pending[tag]
+						results[tag] = (code, text, data)
+				if pending and not queue:
+					if not retry:
+						raise AniDBTimeout()
+					self.retry_msg()
+					queue = list(pending)
+		finally:
+			self.sock.settimeout(timeout)
+		return [results['p{0}'.format(n)] for n in range(len(arglist))]
+	
 	def ping(self):
 		t = time.time()
 		try:
@@ -259,10 +514,14 @@ class AniDB:
 		except AniDBTimeout:
 			return None
 	
-	def auth(self):
-		code, text, data = self.execute('AUTH', {'user': self.username, 'pass': self.password, 'protover': protover, 'client': client, 'clientver': clientver})
+	def auth(self, retry = False):
+		args = {'user': self.username, 'pass': self.password, 'protover': protover, 'client': client, 'clientver': clientver}
+		if self.compress:
+			args['comp'] = 1
+		code, text, data = self.execute('AUTH', args, retry)
 		if code in (LOGIN_ACCEPTED, LOGIN_ACCEPTED_NEW_VERSION):
 			self.session = text.split(' ', 1)[0]
+			self.login_msg()
 			if code == LOGIN_ACCEPTED_NEW_VERSION:
 				self.newver_msg()
 		elif code == LOGIN_FAILED:
@@ -278,23 +537,43 @@ class AniDB:
 			except AniDBError:
 				pass
 	
-	def get_file(self, fid, retry = False):
+	def get_file(self, fid, retry = False, fields = info):
 		try:
 			size, ed2k = fid
 			args = {'size': size, 'ed2k': ed2k}
 		except TypeError:
 			args = {'fid': fid}
-		info_codes = list(info)
-		args.update({'s': self.session})
-		#'fmask': '7BFAFFF900', 'amask': 'F2FCF0C0'
-		
-		args.update({'fmask': '7B0AFFE900'})
-		args.update({'amask': 'F0E0F0C0'})
+		args['fmask'], args['amask'], layout = masks(fields)
+		# Replies for a hash are kept for cache_age seconds.
+		cached = self.cache and self.cache_age and 'ed2k' in args
+		if cached:
+			reply = self.cache.get_file(size, ed2k, args['fmask'], args['amask'], self.cache_age)
+			if reply:
+				return FileInfo(layout, reply)
+		args['s'] = self.session
 		
 		while 1:
 			code, text, data = self.execute('FILE', args, retry)
 			if code == FILE:
-				return dict([(name, data[0].pop(0)) for name in ['fid'] + info_codes])
+				reply = data[0] if data else []
+				if self.truncated:
+					# Cut off even compressed: the fields that did not arrive
+					# are asked for by file id, with a mask that much smaller.
+					if len(reply) < 2:
+						raise AniDBReplyError(code, 'reply truncated')
+					rest = [name for name, kind in layout[len(reply):]]
+					missing = self.get_file(int(reply[0]), retry, rest)
+					reply = reply + ['' if getattr(missing, name) is None else str(getattr(missing, name)) for name in rest]
+				if cached:
+					self.cache.set_file(size, ed2k, args['fmask'], args['amask'], reply)
+				info = FileInfo(layout, reply)
+				# With the mylist fields, the reply says whether the file is in mylist.
+				if self.mylist is not None and info.lid is not None and info.fid:
+					if info.lid:
+						self.mylist.set(info.fid, info.lid, info.mystate, info.viewed, *(fid if 'ed2k' in args else (None, None)))
+					else:
+						self.mylist.forget(info.fid)
+				return info
 			elif code == NO_SUCH_FILE:
 				raise AniDBUnknownFile()
 			elif code in (LOGIN_FIRST, INVALID_SESSION):
@@ -303,6 +582,7 @@ class AniDB:
 				raise AniDBReplyError(code, text)
 	
 	def add_file(self, fid, state = None, viewed = False, source = None, storage = None, other = None, edit = False, retry = False):
+		# Returns whether the entry was added or changed.
 		try:
 			size, ed2k = fid
 			args = {'size': size, 'ed2k': ed2k}
@@ -310,6 +590,11 @@ class AniDB:
 			args = {'fid': fid}
 		if not edit and state == None:
 			state = 'hdd'
+		# Nothing is sent for an entry the local mirror knows in the wanted
+		# state; an add of an existing entry would not change it either.
+		entry = self.mylist is not None and self.mylist.get(fid, self.mylist_age)
+		if entry and (not edit or (state is None or entry['state'] == states[state]) and (viewed is None or entry['viewed'] == int(bool(viewed)))):
+			return False
 		if state != None:
 			args['state'] = states[state]
 		if viewed != None:
@@ -326,16 +611,48 @@ class AniDB:
 		while 1:
 			code, text, data = self.execute('MYLISTADD', args, retry)
 			if code in (MYLIST_ENTRY_ADDED, FILE_ALREADY_IN_MYLIST, MYLIST_ENTRY_EDITED):
-				return
+				if self.mylist is not None:
+					self.remember(fid, code, data, args)
+				return code != FILE_ALREADY_IN_MYLIST
 			elif code == NO_SUCH_FILE:
 				raise AniDBUnknownFile()
 			elif code == NO_SUCH_MYLIST_ENTRY:
+				if self.mylist is not None:
+					self.mylist.forget(fid)
 				raise AniDBNotInMylist()
 			elif code in (LOGIN_FIRST, INVALID_SESSION):
 				self.auth()
 			else:
 				raise AniDBReplyError(code, text)
 
+	def remember(self, fid, code, data, args):
+		size_ed2k = fid if 'ed2k' in args else (None, None)
+		viewed = args.get('viewed')
+		if code == FILE_ALREADY_IN_MYLIST:
+			# lid|fid|eid|aid|gid|date|state|viewdate|storage|source|other|filestate
+			try:
+				lid, fid, state, viewdate = int(data[0][0]), int(data[0][1]), int(data[0][6]), data[0][7]
+			except (IndexError, ValueError):
+				return
+			self.mylist.set(fid, lid, state, int(viewdate not in ('', '0')), *size_ed2k)
+		elif 'fid' in args:
+			lid = None
+			if code == MYLIST_ENTRY_ADDED:
+				try:
+					lid = int(data[0][0])
+				except (IndexError, ValueError):
+					pass
+			self.mylist.set(fid, lid, args.get('state'), viewed)
+		elif code == MYLIST_ENTRY_ADDED:
+			try:
+				self.mylist.set(None, int(data[0][0]), args.get('state'), viewed, *size_ed2k)
+			except (IndexError, ValueError):
+				pass
+		elif code == MYLIST_ENTRY_EDITED:
+			entry = self.mylist.get(fid, float('inf'))
+			if entry:
+				self.mylist.set(entry['fid'], None, args.get('state'), viewed)
+
 	def get_anime(self, aid = None, aname = None, amask = None, retry = False):
 		args = {}
 		if not aid == None:
@@ -360,22 +677,31 @@ class AniDB:
 				raise AniDBReplyError(code, text)
 
 	def get_animedesc(self, aid, retry = False):
-		args = {'aid': aid, 'part': 0, 's': self.session}
-		description = ''
-		while 1:
-			code, text, data = self.execute('ANIMEDESC', args, retry)
-			if code == ANIME_DESCRIPTION:
-				curpart, maxpart, desc = data[0]
-				description += desc
-				if curpart == maxpart:
-					return description
+		# The first reply tells how many parts there are, the rest are pipelined.
+		if self.cache:
+			description = self.cache.get_description(aid)
+			if description is not None:
+				return description
+		parts = {}
+		wanted = [0]
+		while wanted:
+			replies = self.execute_many('ANIMEDESC', [{'aid': aid, 'part': part, 's': self.session} for part in wanted], retry)
+			for part, (code, text, data) in zip(wanted, replies):
+				if code == ANIME_DESCRIPTION:
+					curpart, maxpart, desc = data[0]
+					parts[int(curpart)] = desc
+				elif code == NO_SUCH_ANIME:
+					raise AniDBUnknownAnime()
+				elif code == NO_SUCH_DESCRIPTION:
+					raise AniDBUnknownDescription()
+				elif code in (LOGIN_FIRST, INVALID_SESSION):
+					self.auth()
+					break
 				else:
-					args['part'] = int(curpart)+1
-			elif code == NO_SUCH_ANIME:
-				raise AniDBUnknownAnime()
-			elif code == NO_SUCH_DESCRIPTION:
-				raise AnidBUnknownDescription()
-			elif code in (LOGIN_FIRST, INVALID_SESSION):
-				self.auth()
-			else:
-				raise AniDBReplyError(code, text)
+					raise AniDBReplyError(code, text)
+			if parts:
+				wanted = [part for part in range(int(maxpart)) if part not in parts]
+		description = ''.join(parts[part] for part in sorted(parts))
+		if self.cache:
+			self.cache.set_description(aid, description)
+		return description
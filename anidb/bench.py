@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+# Micro-benchmarks for anidb.hash.
+#
+# Builds a corpus of sparse or synthetic files around the ed2k chunk size,
+# hashes it with every combination of algorithms, block size, worker count
+# and I/O mode and writes one JSON object per measurement. Every digest is
+# checked against a straightforward reference implementation, so an
+# optimisation can never change a hash unnoticed.
+#
+#   python -m anidb.bench --output results.jsonl
+#   python -m anidb.bench --baseline results.jsonl --tolerance 0.1
+#   python -m anidb.bench --startup 20
+#   python -m anidb.bench --synthetic --cold --iomode buffered,dontneed,direct --rate 50
+#
+# Every measurement also reports how much of the corpus is left in the page
+# cache afterwards (resident), with --cold the corpus is dropped from the
+# cache before each run.
+
+import optparse, os, sys, time, json, platform, hashlib, binascii, random, tempfile, shutil, signal, subprocess, statistics, mmap, ctypes, ctypes.util
+from concurrent.futures import ProcessPoolExecutor
+import anidb.hash
+
+CHUNK = 9728000
+
+sizes = (
+	('empty', 0),
+	('small', 1 << 20),
+	('chunk-1', CHUNK - 1),
+	('chunk', CHUNK),
+	('chunk+1', CHUNK + 1),
+	('chunk*2', CHUNK * 2),
+	('chunk*3', CHUNK * 3),
+	)
+
+combos = (
+	('ed2k',),
+	('ed2k', 'crc32'),
+	('ed2k', 'md5', 'sha1', 'crc32'),
+	)
+
+blocksizes = (65536, 131072, 1 << 20, CHUNK)
+
+def parse_size(s):
+	units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+	if s[-1].lower() in units:
+		return int(float(s[:-1]) * units[s[-1].lower()])
+	return int(s)
+
+def make_corpus(directory, sparse = True, large = ()):
+	# Sparse files measure the hashing itself, synthetic ones include real I/O.
+	os.makedirs(directory, exist_ok = True)
+	corpus = []
+	for name, size in list(sizes) + [('large-{0}'.format(s), s) for s in large]:
+		path = os.path.join(directory, '{0}.{1}'.format(name, 'sparse' if sparse else 'bin'))
+		if not os.path.exists(path) or os.path.getsize(path) != size:
+			with open(path, 'wb') as f:
+				if sparse:
+					f.truncate(size)
+				else:
+					block = random.Random(size).randbytes(1 << 20)
+					written = 0
+					while written < size:
+						n = min(len(block), size - written)
+						f.write(block[:n])
+						written += n
+		corpus.append(path)
+	return corpus
+
+def reference(path):
+	# Exact multiples of the chunk size do not get an extra empty chunk, see Ed2k.hexdigest.
+	digests = {'md5': hashlib.md5(), 'sha1': hashlib.sha1()}
+	chunks = []
+	crc = 0
+	with open(path, 'rb') as f:
+		while 1:
+			data = f.read(CHUNK)
+			if not data and chunks:
+				break
+			chunks.append(hashlib.new('md4', data).digest())
+			crc = binascii.crc32(data, crc)
+			for h in digests.values():
+				h.update(data)
+			if len(data) < CHUNK:
+				break
+	result = dict((n, h.hexdigest()) for n, h in digests.items())
+	result['ed2k'] = chunks[0].hex() if len(chunks) == 1 else hashlib.new('md4', b''.join(chunks)).hexdigest()
+	result['crc32'] = '{0:08x}'.format(crc & 0xffffffff)
+	return result
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long)
+libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+libc.mincore.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)
+
+def resident(path):
+	# Bytes of the file in the page cache, from mincore on a mapping of it.
+	size = os.path.getsize(path)
+	if not size:
+		return 0
+	with open(path, 'rb') as f:
+		addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, f.fileno(), 0)
+		if addr in (None, ctypes.c_void_p(-1).value):
+			raise OSError(ctypes.get_errno(), 'mmap failed', path)
+		try:
+			pages = -(-size // mmap.PAGESIZE)
+			vec = (ctypes.c_ubyte * pages)()
+			if libc.mincore(addr, size, vec):
+				raise OSError(ctypes.get_errno(), 'mincore failed', path)
+			return min(sum(b & 1 for b in vec) * mmap.PAGESIZE, size)
+		finally:
+			libc.munmap(addr, size)
+
+def evict(path):
+	# Clean pages are dropped right away.
+	with open(path, 'rb') as f:
+		os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def _hash_one(args):
+	path, algorithms, blocksize, iomode = args
+	h = anidb.hash.Hash(path, algorithms, blocksize, iomode)
+	return path, dict((a, getattr(h, a)()) for a in algorithms)
+
+def measure(corpus, algorithms, blocksize, iomode, threads = 1, processes = 0):
+	t = time.perf_counter()
+	if processes:
+		with ProcessPoolExecutor(processes) as pool:
+			digests = dict(pool.map(_hash_one, [(p, algorithms, blocksize, iomode) for p in corpus]))
+	else:
+		digests = {}
+		for f in anidb.hash.hash_files(list(corpus), False, algorithms, threads, blocksize, iomode):
+			digests[f.name] = dict((a, getattr(f, a)) for a in algorithms)
+	return time.perf_counter() - t, digests
+
+def run(corpus, workers, iomodes, repeat = 1, cold = False):
+	expected = dict((p, reference(p)) for p in corpus)
+	total = sum(os.path.getsize(p) for p in corpus)
+	for algorithms in combos:
+		for blocksize in blocksizes:
+			for iomode in iomodes:
+				for kind, n in workers:
+					best = None
+					for r in range(repeat):
+						if cold:
+							for p in corpus:
+								evict(p)
+						elapsed, digests = measure(corpus, algorithms, blocksize, iomode, *((n, 0) if kind == 'threads' else (1, n)))
+						best = elapsed if best is None else min(best, elapsed)
+					mismatches = [os.path.basename(p) for p in corpus for a in algorithms if digests[p][a] != expected[p][a]]
+					cached = sum(resident(p) for p in corpus)
+					yield {
+						'algorithms': '+'.join(algorithms),
+						'blocksize': blocksize,
+						'iomode': iomode,
+						kind: n,
+						'bytes': total,
+						'seconds': round(best, 6),
+						'mbps': round(total / best / 1e6, 2) if best else None,
+						'resident': round(cached / total, 4) if total else None,
+						'mismatches': mismatches,
+						}
+
+def startup(repeat = 20):
+	# Wall time of a run that finds nothing to do, next to a bare interpreter.
+	script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nzbToAniDB.py')
+	with tempfile.TemporaryDirectory(prefix = 'anidb-startup-') as cwd:
+		os.mkdir(os.path.join(cwd, 'job'))
+		with open(os.path.join(cwd, 'anidb.cfg'), 'w') as f:
+			f.write('[AniDB]\nidentify = yes\ntvdb = yes\nmove = yes\ndirectory = {0}\ndirectorymovie = {0}\ncolor = no\n'.format(cwd))
+		for name, cmd in (('python', [sys.executable, '-c', 'pass']), ('nothing-to-do', [sys.executable, script, 'job'])):
+			times = []
+			for r in range(repeat):
+				t = time.perf_counter()
+				subprocess.run(cmd, cwd = cwd, stdout = subprocess.DEVNULL, check = True)
+				times.append(time.perf_counter() - t)
+			yield {'startup': name, 'runs': repeat, 'min_ms': round(min(times) * 1000, 2), 'median_ms': round(statistics.median(times) * 1000, 2)}
+
+def key(result):
+	return tuple(result.get(k) for k in ('algorithms', 'blocksize', 'iomode', 'threads', 'processes'))
+
+def compare(results, baseline, tolerance):
+	old = {}
+	with open(baseline) as f:
+		for line in f:
+			r = json.loads(line)
+			if 'mbps' in r:
+				old[key(r)] = r['mbps']
+	regressions = []
+	for r in results:
+		base = old.get(key(r))
+		if base and r['mbps'] is not None and r['mbps'] < base * (1 - tolerance):
+			regressions.append((r, base))
+	return regressions
+
+def main():
+	op = optparse.OptionParser(usage = 'python -m anidb.bench [options]')
+	op.add_option('-d', '--dir', dest = 'directory', help = 'Corpus directory (default: temporary).')
+	op.add_option('-s', '--synthetic', action = 'store_true', help = 'Write real data instead of sparse files.')
+	op.add_option('-L', '--large', action = 'append', default = [], help = 'Additional large file size, e.g. 4G (repeatable).')
+	op.add_option('-t', '--threads', default = '1,2,4', help = 'Thread counts to measure.')
+	op.add_option('-p', '--processes', default = '', help = 'Process counts to measure.')
+	op.add_option('-i', '--iomode', default = ','.join(anidb.hash.io_modes), help = 'I/O modes to measure.')
+	op.add_option('-c', '--cold', action = 'store_true', help = 'Drop the corpus from the page cache before each run.')
+	op.add_option('-R', '--rate', type = 'float', default = 0, help = 'Cap reads at this many MB/s (threads share the cap).')
+	op.add_option('-r', '--repeat', type = 'int', default = 1, help = 'Repetitions, the fastest one counts.')
+	op.add_option('-o', '--output', help = 'Write JSON lines here instead of stdout.')
+	op.add_option('-b', '--baseline', help = 'Earlier results to check for regressions.')
+	op.add_option('--tolerance', type = 'float', default = 0.1, help = 'Allowed slowdown against the baseline.')
+	op.add_option('--startup', type = 'int', metavar = 'RUNS', help = 'Only measure script startup on an empty job.')
+	options, args = op.parse_args()
+
+	if options.startup:
+		for r in startup(options.startup):
+			print(json.dumps(r))
+		return
+
+	# A temporary corpus is removed again, one given with --dir is kept; a
+	# TERM signal unwinds like an error so it is removed then too.
+	directory = options.directory or tempfile.mkdtemp(prefix = 'anidb-bench-')
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+	try:
+		anidb.hash.limit(options.rate * 1e6)
+		corpus = make_corpus(directory, not options.synthetic, [parse_size(s) for s in options.large])
+		workers = [('threads', int(n)) for n in options.threads.split(',') if n] + [('processes', int(n)) for n in options.processes.split(',') if n]
+
+		out = open(options.output, 'w') if options.output else sys.stdout
+		out.write(json.dumps({'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time(), 'corpus': directory, 'sparse': not options.synthetic, 'cold': bool(options.cold), 'rate': options.rate}) + '\n')
+		results = []
+		for r in run(corpus, workers, options.iomode.split(','), options.repeat, options.cold):
+			results.append(r)
+			out.write(json.dumps(r) + '\n')
+			out.flush()
+		if out is not sys.stdout:
+			out.close()
+
+		failed = False
+		for r in results:
+			if r['mismatches']:
+				print('Hash mismatch: {0} ({1}, {2}, {3})'.format(', '.join(r['mismatches']), r['algorithms'], r['blocksize'], r['iomode']), file = sys.stderr)
+				failed = True
+		if options.baseline:
+			for r, base in compare(results, options.baseline, options.tolerance):
+				print('Regression: {0} {1} MB/s (baseline {2} MB/s)'.format(key(r), r['mbps'], base), file = sys.stderr)
+				failed = True
+		sys.exit(1 if failed else 0)
+	finally:
+		if not options.directory:
+			shutil.rmtree(directory, ignore_errors = True)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,59 @@
+import os, time
+from anidb.cache import Database
+
+class Checkpoint(Database):
+	# Files finished by a bulk run over a library, so a killed run can resume.
+	schema = '''
+		CREATE TABLE IF NOT EXISTS checkpoint (
+			library TEXT NOT NULL,
+			path TEXT NOT NULL,
+			size INTEGER NOT NULL,
+			mtime INTEGER NOT NULL,
+			status TEXT NOT NULL,
+			time REAL NOT NULL,
+			PRIMARY KEY (library, path)
+		);
+	'''
+
+	def __init__(self, path, library):
+		Database.__init__(self, path)
+		self.library = '\n'.join(sorted(os.path.abspath(p) for p in library))
+
+	def clear(self):
+		with self.db:
+			self.db.execute('DELETE FROM checkpoint WHERE library = ?', (self.library,))
+
+	def pending(self, files):
+		done = dict(((p, (s, m)) for p, s, m in self.db.execute('SELECT path, size, mtime FROM checkpoint WHERE library = ?', (self.library,))))
+		for name in files:
+			st = os.stat(name)
+			if done.get(os.path.abspath(name)) != (st.st_size, int(st.st_mtime)):
+				yield name, st.st_size
+
+	def done(self, file, target, status):
+		# The target is recorded too, a renamed file is found there on resume.
+		rows = [(self.library, os.path.abspath(p), file.size, int(file.mtime), status, time.time()) for p in {file.name, target}]
+		with self.db:
+			self.db.executemany('INSERT OR REPLACE INTO checkpoint VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+class Progress:
+	def __init__(self, files, size, skipped = 0):
+		self.files = files
+		self.size = size
+		self.skipped = skipped
+		self.done_files = 0
+		self.done_size = 0
+		self.start = time.time()
+
+	def update(self, size):
+		self.done_files += 1
+		self.done_size += size
+
+	def __str__(self):
+		elapsed = time.time() - self.start
+		rate = self.done_size / elapsed if elapsed else 0
+		eta = (self.size - self.done_size) / rate if rate else None
+		return '{0}/{1} files, {2:.1f}/{3:.1f} GB, {4:.1f} MB/s, ETA {5}{6}'.format(
+			self.done_files, self.files, self.done_size / 1e9, self.size / 1e9, rate / 1e6,
+			'{0}:{1:02d}:{2:02d}'.format(int(eta // 3600), int(eta % 3600 // 60), int(eta % 60)) if eta is not None else '?',
+			' ({0} done earlier)'.format(self.skipped) if self.skipped else '')
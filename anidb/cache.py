@@ -0,0 +1,47 @@
+import sqlite3, time
+
+class Database:
+	schema = ''
+
+	def __init__(self, path):
+		self.path = str(path)
+		self.db = sqlite3.connect(self.path, timeout = 30, check_same_thread = False)
+		self.db.executescript('PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;' + self.schema)
+
+	def close(self):
+		self.db.close()
+
+class Cache(Database):
+	# AniDB replies kept across runs.
+	schema = '''
+		CREATE TABLE IF NOT EXISTS description (
+			aid INTEGER PRIMARY KEY,
+			text TEXT NOT NULL,
+			time REAL NOT NULL
+		);
+		CREATE TABLE IF NOT EXISTS file (
+			size INTEGER NOT NULL,
+			ed2k TEXT NOT NULL,
+			fmask TEXT NOT NULL,
+			amask TEXT NOT NULL,
+			reply TEXT NOT NULL,
+			time REAL NOT NULL,
+			PRIMARY KEY (size, ed2k, fmask, amask)
+		);
+	'''
+
+	def get_description(self, aid):
+		row = self.db.execute('SELECT text FROM description WHERE aid = ?', (int(aid),)).fetchone()
+		return row and row[0]
+
+	def set_description(self, aid, text):
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO description VALUES (?, ?, ?)', (int(aid), text, time.time()))
+
+	def get_file(self, size, ed2k, fmask, amask, maxage):
+		row = self.db.execute('SELECT reply FROM file WHERE size = ? AND ed2k = ? AND fmask = ? AND amask = ? AND time > ?', (size, ed2k, fmask, amask, time.time() - maxage)).fetchone()
+		return row and row[0].split('|')
+
+	def set_file(self, size, ed2k, fmask, amask, reply):
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?, ?, ?)', (size, ed2k, fmask, amask, '|'.join(reply), time.time()))
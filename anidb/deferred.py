@@ -0,0 +1,98 @@
+import os, time, sqlite3
+from pathlib import Path
+from anidb.cache import Database
+
+# Seconds until the next try, by reason and number of tries so far. Timeouts
+# are retried soon, a ban lasts at least half an hour and grows with every
+# request sent during it, a file AniDB does not know yet may take days to be added.
+backoff = {
+	'timeout': (600, 1800, 3600, 7200, 21600),
+	'banned': (3600, 7200, 21600, 86400),
+	'unknown': (21600, 86400, 3 * 86400, 7 * 86400),
+	}
+
+class StoredFile:
+	# Same attributes as anidb.hash.File, from the hashes kept in the queue.
+	def __init__(self, row):
+		self.name = Path(row['path'])
+		self.size = row['size']
+		self.mtime = row['mtime']
+		self.cached = True
+		self.hashtime = 0.0
+		self.deferred = row['reason']
+		for a in ('ed2k', 'md5', 'sha1', 'crc32'):
+			if row[a]:
+				setattr(self, a, row[a])
+
+class Deferred(Database):
+	# Hashed files that could not be identified yet.
+	schema = '''
+		CREATE TABLE IF NOT EXISTS deferred (
+			path TEXT PRIMARY KEY,
+			size INTEGER NOT NULL,
+			mtime REAL NOT NULL,
+			ed2k TEXT NOT NULL,
+			md5 TEXT,
+			sha1 TEXT,
+			crc32 TEXT,
+			reason TEXT NOT NULL,
+			attempts INTEGER NOT NULL,
+			next REAL NOT NULL,
+			time REAL NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS deferred_next ON deferred (next);
+	'''
+
+	def __init__(self, path, giveup = 12):
+		# giveup: tries before a file AniDB still does not know is dropped.
+		Database.__init__(self, path)
+		self.db.row_factory = sqlite3.Row
+		self.giveup = giveup
+
+	def park(self, file, reason, path = None):
+		path = os.path.abspath(path or file.name)
+		row = self.db.execute('SELECT attempts, reason FROM deferred WHERE path = ?', (path,)).fetchone()
+		attempts = row['attempts'] + 1 if row and row['reason'] == reason else 0
+		if reason == 'unknown' and attempts >= self.giveup:
+			self.remove(path)
+			return None
+		delays = backoff[reason]
+		delay = delays[min(attempts, len(delays) - 1)]
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO deferred VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+				path, file.size, file.mtime, file.ed2k, getattr(file, 'md5', None), getattr(file, 'sha1', None), getattr(file, 'crc32', None),
+				reason, attempts, time.time() + delay, time.time()))
+		return delay
+
+	def remove(self, path):
+		with self.db:
+			self.db.execute('DELETE FROM deferred WHERE path = ?', (os.path.abspath(path),))
+
+	def due(self, limit = None, everything = False):
+		# Files still unchanged at their path, oldest try first. The others
+		# were moved or replaced and leave the queue.
+		cursor = self.db.execute('SELECT * FROM deferred WHERE next <= ? ORDER BY next', (float('inf') if everything else time.time(),))
+		files = []
+		for row in cursor.fetchall():
+			try:
+				st = os.stat(row['path'])
+			except OSError:
+				st = None
+			if not st or st.st_size != row['size'] or int(st.st_mtime) != int(row['mtime']):
+				self.remove(row['path'])
+				continue
+			files.append(StoredFile(row))
+			if limit and len(files) >= limit:
+				break
+		return files
+
+	def remaining(self):
+		# Seconds until the next file is due, None for an empty queue.
+		row = self.db.execute('SELECT MIN(next) FROM deferred').fetchone()
+		return None if row[0] is None else max(row[0] - time.time(), 0)
+
+	def __contains__(self, path):
+		return self.db.execute('SELECT 1 FROM deferred WHERE path = ?', (os.path.abspath(path),)).fetchone() is not None
+
+	def __len__(self):
+		return self.db.execute('SELECT COUNT(*) FROM deferred').fetchone()[0]
@@ -1,4 +1,5 @@
-import threading, time, os, hashlib, binascii
+import threading, time, os, mmap, errno, hashlib, binascii
+from anidb.schedule import Scheduler
 try:
 	import xattr
 except ImportError:
@@ -44,35 +45,116 @@ hasher_obj = {
 	'crc32': Crc32,
 }
 
+# buffered and raw go through the page cache as usual. sequential tells the
+# kernel the file is read front to back and asks for the next block while the
+# current one is hashed, dontneed also drops every block from the cache once
+# it was hashed, direct reads with O_DIRECT into an aligned buffer and falls
+# back to dontneed where the file system does not support it.
+io_modes = ('buffered', 'raw', 'sequential', 'dontneed', 'direct')
+
+fadvise = hasattr(os, 'posix_fadvise')
+
+class RateLimit:
+	# Caps the bytes read per second over all hashing threads.
+	def __init__(self, rate):
+		self.rate = rate
+		self.lock = threading.Lock()
+		self.t = 0.0
+	
+	def take(self, n):
+		with self.lock:
+			now = time.perf_counter()
+			# Up to a second of reads may be caught up after an idle period.
+			self.t = max(self.t, now - 1.0) + n / self.rate
+			delay = self.t - now
+		if delay > 0:
+			time.sleep(delay)
+
+rate_limit = None
+
+def limit(rate):
+	# Bytes per second for all following reads, 0 for no limit.
+	global rate_limit
+	rate_limit = RateLimit(rate) if rate else None
+
+def read_direct(filename, blocksize):
+	fd = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+	try:
+		# mmap memory is page aligned, so is the block size.
+		blocksize = -(-blocksize // mmap.PAGESIZE) * mmap.PAGESIZE
+		buf = mmap.mmap(-1, blocksize)
+		view = memoryview(buf)
+		while 1:
+			n = os.readv(fd, [buf])
+			if not n:
+				break
+			yield view[:n]
+	finally:
+		os.close(fd)
+
+def read_blocks(filename, blocksize = 131072, iomode = 'buffered'):
+	if iomode == 'direct':
+		if hasattr(os, 'O_DIRECT'):
+			blocks = read_direct(filename, blocksize)
+			try:
+				data = next(blocks, None)
+			except OSError as e:
+				if e.errno != errno.EINVAL:
+					raise
+			else:
+				while data is not None:
+					if rate_limit:
+						rate_limit.take(len(data))
+					yield data
+					data = next(blocks, None)
+				return
+		iomode = 'dontneed'
+	with open(filename, 'rb', buffering = 0 if iomode != 'buffered' else -1) as f:
+		advise = fadvise and iomode in ('sequential', 'dontneed')
+		if advise:
+			fd = f.fileno()
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+		pos = 0
+		data = f.read(blocksize)
+		while data:
+			if rate_limit:
+				rate_limit.take(len(data))
+			if advise:
+				os.posix_fadvise(fd, pos + len(data), blocksize, os.POSIX_FADV_WILLNEED)
+			yield data
+			if advise and iomode == 'dontneed':
+				os.posix_fadvise(fd, pos, len(data), os.POSIX_FADV_DONTNEED)
+			pos += len(data)
+			data = f.read(blocksize)
+
 class Hash:
-	def __init__(self, filename, algorithms):
+	def __init__(self, filename, algorithms, blocksize = 131072, iomode = 'buffered'):
 		update_list = []
 		for a in algorithms:
 			h = hasher_obj[a]()
 			update_list.append(h.update)
 			setattr(self, a, h.hexdigest)
 		
-		f = open(filename, 'rb')
-		data = f.read(131072)
-		while data:
+		for data in read_blocks(filename, blocksize, iomode):
 			for u in update_list:
 				u(data)
-			data = f.read(131072)
 
 class File:
-	def __init__(self, name, algorithms, cache):
+	def __init__(self, name, algorithms, cache, blocksize = 131072, iomode = 'buffered'):
 		self.name = name
 		self.size = os.path.getsize(name)
 		self.mtime = os.path.getmtime(name)
 		self.cached = False
+		self.hashtime = 0.0
 		if cache:
-			print("test")
 			self.read_cache()
 		if False in [hasattr(self, a) for a in algorithms]:
 			self.cached = False
-			h = Hash(name, algorithms)
+			t = time.perf_counter()
+			h = Hash(name, algorithms, blocksize, iomode)
 			for a in algorithms:
 				setattr(self, a, getattr(h, a)())
+			self.hashtime = time.perf_counter() - t
 			if cache: self.write_cache()
 	
 	def read_cache(self):
@@ -103,30 +185,70 @@ class File:
 				xattr.remove(self.name, name)
 
 class Hashthread(threading.Thread):
-	def __init__(self, filelist, hashlist, algorithms, cache, *args, **kwargs):
-		self.filelist = filelist
-		self.hashlist = hashlist
+	def __init__(self, pending, done, algorithms, cache, blocksize = 131072, iomode = 'buffered', make_file = File, job = os.path.dirname, stats = None, failed = None, *args, **kwargs):
+		self.pending = pending
+		self.done = done
+		self.make_file = make_file
 		self.algorithms = algorithms
 		self.cache = cache
+		self.blocksize = blocksize
+		self.iomode = iomode
+		self.job = job
+		self.stats = stats
+		self.failed = failed
 		threading.Thread.__init__(self, *args, **kwargs)
 	def run(self):
+		while 1:
+			got = self.pending.get()
+			if got is None:
+				return
+			f, wait, depth = got
+			if self.stats:
+				self.stats.record('hash-queue', f, wait, depth = depth)
+			try:
+				h = self.make_file(f, self.algorithms, self.cache, self.blocksize, self.iomode)
+			except OSError as e:
+				print('Could not hash {0}: {1}'.format(f, e))
+				if self.failed is not None:
+					self.failed.append(f)
+				continue
+			self.done.put(h, h.size, self.job(h.name))
+
+def hash_files(files, cache = False, algorithms = ('ed2k',), num_threads = 1, blocksize = 131072, iomode = 'buffered', make_file = File, policy = 'fifo', job = os.path.dirname, stats = None, failed = None):
+	# make_file builds the hashed file object, e.g. a worker.Dispatcher for remote storage.
+	# Files that could not be hashed are appended to failed, if given.
+	# files may be a generator, hashing starts while it is still producing.
+	# Files waiting to be hashed and hashed files waiting to be handed out are
+	# both ordered by policy (see anidb.schedule), job(name) groups files into jobs.
+	pending = Scheduler(policy)
+	done = Scheduler(policy)
+
+	def feed():
 		try:
-			while 1:
-				f = self.filelist.pop(0)
-				self.hashlist.append(File(f, self.algorithms, self.cache))
-		except IndexError:
-			return
+			for f in files:
+				size = 0
+				if policy == 'smallest':
+					try:
+						size = os.path.getsize(f)
+					except OSError:
+						pass
+				pending.put(f, size, job(f))
+		finally:
+			pending.close()
+
+	def close():
+		for thread in threads:
+			thread.join()
+		done.close()
 
-def hash_files(files, cache = False, algorithms = ('ed2k',), num_threads = 1):
-	hashlist = []
-	threads = []
-	for x in range(num_threads):
-		thread = Hashthread(files, hashlist, algorithms, cache)
+	threads = [Hashthread(pending, done, algorithms, cache, blocksize, iomode, make_file, job, stats, failed) for x in range(num_threads)]
+	for thread in [threading.Thread(target = feed, daemon = True)] + threads + [threading.Thread(target = close, daemon = True)]:
 		thread.start()
-		threads.append(thread)
-	while hashlist or sum([thread.isAlive() for thread in threads]):
-		try:
-			yield hashlist.pop(0)
-		except IndexError:
-			time.sleep(0.1)
-	return
+	while 1:
+		got = done.get()
+		if got is None:
+			return
+		f, wait, depth = got
+		if stats:
+			stats.record('id-queue', f.name, wait, depth = depth)
+		yield f
@@ -0,0 +1,74 @@
+import os, time, sqlite3
+from anidb.cache import Database
+
+# AniDB quality names, worst first.
+qualities = ('corrupted', 'eye cancer', 'very low', 'low', 'med', 'high', 'very high')
+
+def rank(version, quality, vres):
+	# Higher is better: version first, then quality, then resolution.
+	try:
+		w, h = vres.split('x')
+		pixels = int(w) * int(h)
+	except (AttributeError, ValueError):
+		pixels = 0
+	return (version or 1, qualities.index(quality) if quality in qualities else -1, pixels)
+
+class LibraryIndex(Database):
+	# Every identified file with its final path, keyed by content.
+	schema = '''
+		CREATE TABLE IF NOT EXISTS library (
+			size INTEGER NOT NULL,
+			ed2k TEXT NOT NULL,
+			fid INTEGER,
+			aid INTEGER,
+			eid INTEGER,
+			epno TEXT,
+			version INTEGER,
+			quality TEXT,
+			vres TEXT,
+			path TEXT NOT NULL,
+			time REAL NOT NULL,
+			PRIMARY KEY (size, ed2k)
+		);
+		CREATE INDEX IF NOT EXISTS library_episode ON library (aid, eid);
+		CREATE INDEX IF NOT EXISTS library_fid ON library (fid);
+		CREATE INDEX IF NOT EXISTS library_path ON library (path);
+	'''
+
+	fields = ('aid', 'eid', 'epno', 'state', 'quality', 'vres')
+
+	def __init__(self, path):
+		Database.__init__(self, path)
+		self.db.row_factory = sqlite3.Row
+
+	def lookup(self, size, ed2k):
+		return self.db.execute('SELECT * FROM library WHERE size = ? AND ed2k = ?', (size, ed2k)).fetchone()
+
+	def episode(self, aid, eid):
+		return self.db.execute('SELECT * FROM library WHERE aid = ? AND eid = ?', (aid, eid)).fetchall()
+
+	def add(self, file, info, path):
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO library VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+				file.size, file.ed2k, info.fid, info.aid, info.eid, info.epno,
+				info.version, info.quality, info.vres, os.path.abspath(path), time.time()))
+
+	def remove(self, size, ed2k):
+		with self.db:
+			self.db.execute('DELETE FROM library WHERE size = ? AND ed2k = ?', (size, ed2k))
+
+	def duplicate(self, file):
+		# An existing copy of exactly this file somewhere else in the library.
+		row = self.lookup(file.size, file.ed2k)
+		if row and row['path'] != os.path.abspath(file.name) and os.path.exists(row['path']):
+			return row
+
+	def versions(self, file, info):
+		# Other files of the same episode that still exist, split into worse and better ones.
+		new = rank(info.version, info.quality, info.vres)
+		worse, better = [], []
+		for row in self.episode(info.aid, info.eid):
+			if row['ed2k'] == file.ed2k or not os.path.exists(row['path']):
+				continue
+			(worse if rank(row['version'], row['quality'], row['vres']) < new else better).append(row)
+		return worse, better
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+# Local mirror of the AniDB mylist, so files already in it in the wanted
+# state cost no MYLISTADD. It is filled from FILE and MYLISTADD replies and
+# from mylist exports in CSV form with a header row:
+#
+#   python -m anidb.mylist --database nzbToAniDB.db mylist.csv
+
+import optparse, os, sys, time, csv, re, sqlite3
+from anidb.cache import Database
+
+class Mylist(Database):
+	schema = '''
+		CREATE TABLE IF NOT EXISTS mylist (
+			fid INTEGER PRIMARY KEY,
+			lid INTEGER,
+			size INTEGER,
+			ed2k TEXT,
+			state INTEGER,
+			viewed INTEGER,
+			time REAL NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS mylist_hash ON mylist (size, ed2k);
+	'''
+
+	def __init__(self, path):
+		Database.__init__(self, path)
+		self.db.row_factory = sqlite3.Row
+
+	def get(self, fid, maxage):
+		# The entry for fid (a file id or (size, ed2k)) if it was seen in the last maxage seconds.
+		try:
+			size, ed2k = fid
+		except TypeError:
+			return self.db.execute('SELECT * FROM mylist WHERE fid = ? AND time > ?', (fid, time.time() - maxage)).fetchone()
+		return self.db.execute('SELECT * FROM mylist WHERE size = ? AND ed2k = ? AND time > ?', (size, ed2k.lower(), time.time() - maxage)).fetchone()
+
+	def set(self, fid, lid = None, state = None, viewed = None, size = None, ed2k = None):
+		# Known values are kept for what a reply does not mention. Without a
+		# file id (an add by hash) the entry is kept under the negated list
+		# id until a reply names the file.
+		if fid is None:
+			old = size and ed2k and self.get((size, ed2k), float('inf'))
+			if not old and not lid:
+				return
+			fid = old['fid'] if old else -lid
+		old = self.db.execute('SELECT * FROM mylist WHERE fid = ?', (fid,)).fetchone()
+		if old:
+			lid, state, viewed, size, ed2k = [v if v is not None else old[k] for k, v in (('lid', lid), ('state', state), ('viewed', viewed), ('size', size), ('ed2k', ed2k))]
+		with self.db:
+			if size and ed2k:
+				self.db.execute('DELETE FROM mylist WHERE size = ? AND ed2k = ? AND fid != ?', (size, ed2k.lower(), fid))
+			self.db.execute('INSERT OR REPLACE INTO mylist VALUES (?, ?, ?, ?, ?, ?, ?)', (fid, lid, size, ed2k and ed2k.lower(), state, viewed, time.time()))
+
+	def forget(self, fid):
+		try:
+			size, ed2k = fid
+		except TypeError:
+			query, args = 'fid = ?', (fid,)
+		else:
+			query, args = 'size = ? AND ed2k = ?', (size, ed2k.lower())
+		with self.db:
+			self.db.execute('DELETE FROM mylist WHERE ' + query, args)
+
+	def __len__(self):
+		return self.db.execute('SELECT COUNT(*) FROM mylist').fetchone()[0]
+
+	# Export columns, by their name in lower case without punctuation.
+	columns = {
+		'fid': 'fid', 'fileid': 'fid',
+		'lid': 'lid', 'listid': 'lid', 'mylistid': 'lid',
+		'state': 'state', 'mystate': 'state',
+		'viewed': 'viewed', 'watched': 'viewed', 'viewdate': 'viewdate',
+		'size': 'size', 'filesize': 'size',
+		'ed2k': 'ed2k', 'ed2khash': 'ed2k',
+		}
+
+	def load(self, lines):
+		# Imports a CSV mylist export, returns the number of entries.
+		rows = csv.reader(lines)
+		header = [self.columns.get(re.sub('[^a-z0-9]', '', h.lower())) for h in next(rows)]
+		if 'fid' not in header:
+			raise ValueError('the export has no file id column')
+		entries = []
+		for row in rows:
+			entry = dict((k, v.strip()) for k, v in zip(header, row) if k and v.strip())
+			if not entry.get('fid', '').isdigit():
+				continue
+			viewed = entry.get('viewed')
+			if viewed is None and 'viewdate' in entry:
+				viewed = entry['viewdate'] not in ('0', '')
+			elif viewed is not None:
+				viewed = viewed.lower() in ('1', 'yes', 'true')
+			entries.append((int(entry['fid']), int(entry['lid']) if entry.get('lid', '').isdigit() else None,
+				int(entry['size']) if entry.get('size', '').isdigit() else None, entry.get('ed2k', '').lower() or None,
+				int(entry['state']) if entry.get('state', '').isdigit() else None,
+				None if viewed is None else int(viewed), time.time()))
+		with self.db:
+			self.db.executemany('INSERT OR REPLACE INTO mylist VALUES (?, ?, ?, ?, ?, ?, ?)', entries)
+		return len(entries)
+
+def main():
+	op = optparse.OptionParser(usage = 'python -m anidb.mylist [options] EXPORT.csv')
+	op.add_option('-d', '--database', default = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nzbToAniDB.db'), help = 'Local database (default: next to nzbToAniDB.py).')
+	op.add_option('-c', '--clear', action = 'store_true', help = 'Drop the mirror before the import.')
+	options, args = op.parse_args()
+	if len(args) != 1:
+		op.error('one mylist export is required')
+	mylist = Mylist(options.database)
+	if options.clear:
+		with mylist.db:
+			mylist.db.execute('DELETE FROM mylist')
+	with open(args[0], newline = '', encoding = 'utf-8-sig') as f:
+		try:
+			n = mylist.load(f)
+		except ValueError as e:
+			sys.exit('{0}: {1}'.format(args[0], e))
+	print('Imported {0} mylist entries, {1} in the mirror.'.format(n, len(mylist)))
+
+if __name__ == '__main__':
+	main()
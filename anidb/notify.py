@@ -0,0 +1,132 @@
+import time, json, base64, http.client, urllib.parse
+import xml.etree.ElementTree as ET
+
+class NotifyError(Exception):
+	pass
+
+class Server:
+	# One kept-alive HTTP connection per media server, reopened once if the
+	# server closed it in between.
+	name = 'Media server'
+
+	def __init__(self, host, port, mapping = ()):
+		self.host = host
+		self.port = int(port)
+		self.mapping = [(str(local).rstrip('/'), remote.rstrip('/')) for local, remote in mapping if remote]
+		self.conn = None
+
+	def remote(self, path):
+		# Path as the server sees it.
+		path = str(path)
+		for local, remote in self.mapping:
+			if path == local or path.startswith(local + '/'):
+				return remote + path[len(local):]
+		return path
+
+	def request(self, method, url, body = None, headers = {}):
+		for attempt in (0, 1):
+			if self.conn is None:
+				self.conn = http.client.HTTPConnection(self.host, self.port, timeout = 30)
+			try:
+				self.conn.request(method, url, body, headers)
+				response = self.conn.getresponse()
+				data = response.read()
+			except (OSError, http.client.HTTPException):
+				self.close()
+				if attempt:
+					raise
+				continue
+			if response.status >= 400:
+				raise NotifyError('{0} {1}'.format(response.status, response.reason))
+			return data
+
+	def close(self):
+		if self.conn:
+			self.conn.close()
+			self.conn = None
+
+class Plex(Server):
+	name = 'Plex Media Server'
+
+	def __init__(self, host, port = 32400, token = '', sections = '', mapping = ()):
+		Server.__init__(self, host, port, mapping)
+		self.token = token
+		self.wanted = [s.strip() for s in sections.split(',') if s.strip()]
+		self.locations = None
+
+	def headers(self):
+		return {'X-Plex-Token': self.token} if self.token else {}
+
+	def sections(self, path):
+		# Sections whose folders contain path, the section list is fetched once.
+		if self.locations is None:
+			tree = ET.fromstring(self.request('GET', '/library/sections', headers = self.headers()))
+			self.locations = [(d.get('key'), l.get('path').rstrip('/')) for d in tree.iter('Directory') for l in d.iter('Location')]
+		keys = [key for key, location in self.locations if path == location or path.startswith(location + '/')]
+		if self.wanted:
+			keys = [key for key in keys if key in self.wanted]
+		if not keys:
+			raise NotifyError('no library section contains ' + path)
+		return sorted(set(keys))
+
+	def refresh(self, path):
+		path = self.remote(path)
+		for key in self.sections(path):
+			self.request('GET', '/library/sections/{0}/refresh?{1}'.format(key, urllib.parse.urlencode({'path': path})), headers = self.headers())
+
+class Kodi(Server):
+	name = 'Kodi'
+
+	def __init__(self, host, port = 8080, user = '', password = '', mapping = ()):
+		Server.__init__(self, host, port, mapping)
+		self.auth = 'Basic ' + base64.b64encode('{0}:{1}'.format(user, password).encode()).decode() if user else None
+
+	def refresh(self, path):
+		body = json.dumps({'jsonrpc': '2.0', 'method': 'VideoLibrary.Scan', 'params': {'directory': self.remote(path) + '/'}, 'id': 1})
+		headers = {'Content-Type': 'application/json'}
+		if self.auth:
+			headers['Authorization'] = self.auth
+		reply = json.loads(self.request('POST', '/jsonrpc', body, headers))
+		if 'error' in reply:
+			raise NotifyError(reply['error'].get('message', reply['error']))
+
+class Notifier:
+	# Collects the directories files were placed in and refreshes each of them
+	# once `debounce` seconds after the first one came in. A directory below
+	# another pending one is left out, both servers scan paths recursively.
+	def __init__(self, servers, debounce = 0):
+		self.servers = servers
+		self.debounce = debounce
+		self.pending = {}
+
+	def touch(self, path):
+		self.pending.setdefault(str(path).rstrip('/'), time.time())
+
+	def remaining(self):
+		if not self.pending:
+			return None
+		return max(min(self.pending.values()) + self.debounce - time.time(), 0)
+
+	def flush(self, force = False):
+		# Returns (server, path, error) for every refresh sent.
+		if not self.pending or not force and self.remaining() > 0:
+			return []
+		paths = sorted(self.pending)
+		self.pending = {}
+		top = []
+		for path in paths:
+			if not any(path.startswith(t + '/') for t in top):
+				top.append(path)
+		results = []
+		for server in self.servers:
+			for path in top:
+				try:
+					server.refresh(path)
+					results.append((server, path, None))
+				except (OSError, http.client.HTTPException, ET.ParseError, ValueError, NotifyError) as e:
+					results.append((server, path, e))
+		return results
+
+	def close(self):
+		for server in self.servers:
+			server.close()
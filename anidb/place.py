@@ -0,0 +1,86 @@
+import os, errno, shutil
+
+# move: rename, copied and deleted across file systems. The others keep the
+# source, e.g. for seeding, and fall back along the rest of `chain` in order.
+modes = ('move', 'reflink', 'hardlink', 'symlink', 'copy')
+chain = ('reflink', 'hardlink', 'symlink', 'copy')
+
+# From linux/fs.h, clones the extents of one file into another (btrfs, XFS, bcachefs).
+FICLONE = 0x40049409
+
+# What makes a method unusable for a file, the next one is tried then.
+unsupported = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EMLINK}
+
+def reflink(src, dst):
+	import fcntl
+	with open(src, 'rb') as s, open(dst, 'xb') as d:
+		try:
+			fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+		except OSError:
+			d.close()
+			os.remove(dst)
+			raise
+	shutil.copystat(src, dst)
+
+def hardlink(src, dst):
+	os.link(src, dst)
+
+def symlink(src, dst):
+	os.symlink(os.path.abspath(src), dst)
+
+def copy(src, dst):
+	shutil.copy2(src, dst)
+
+methods = {'reflink': reflink, 'hardlink': hardlink, 'symlink': symlink, 'copy': copy}
+
+class Placer:
+	# Places files in one mode and counts, per run, the files each method
+	# placed and the bytes that had to be copied.
+	def __init__(self, mode = 'move'):
+		if mode not in modes:
+			raise ValueError('unknown placement mode: {0}'.format(mode))
+		self.mode = mode
+		self.counts = dict((m, 0) for m in modes)
+		self.copied = 0
+
+	def place(self, src, dst, size):
+		# Returns the method used and the bytes it copied.
+		if self.mode == 'move':
+			try:
+				os.rename(src, dst)
+				copied = 0
+			except OSError as e:
+				if e.errno != errno.EXDEV:
+					raise
+				self.copy(shutil.move, src, dst)
+				copied = size
+			return self.done('move', copied)
+		for method in chain[chain.index(self.mode):]:
+			try:
+				if method == 'copy':
+					self.copy(copy, src, dst)
+				else:
+					methods[method](src, dst)
+			except (OSError, ImportError) as e:
+				if method == 'copy' or getattr(e, 'errno', errno.ENOSYS) not in unsupported:
+					raise
+				continue
+			return self.done(method, size if method == 'copy' else 0)
+
+	def copy(self, how, src, dst):
+		# A copy that fails halfway (e.g. a full disk) leaves no partial target.
+		try:
+			how(str(src), str(dst))
+		except OSError:
+			if os.path.exists(src) and os.path.lexists(dst):
+				os.remove(dst)
+			raise
+
+	def done(self, method, copied):
+		self.counts[method] += 1
+		self.copied += copied
+		return method, copied
+
+	def report(self):
+		placed = ', '.join('{0} {1}'.format(n, m) for m, n in self.counts.items() if n)
+		return placed and '{0}; {1:.1f} MB copied'.format(placed, self.copied / 1e6)
@@ -0,0 +1,79 @@
+import os, time, functools, threading, cProfile, pstats, tracemalloc
+
+class Profiler:
+	def __init__(self, directory = '.', trace_malloc = False, frames = 1):
+		self.directory = directory
+		self.trace_malloc = trace_malloc
+		self.frames = frames
+		self.markers = {}
+		self.profile = cProfile.Profile()
+		self.threads = []
+		self.lock = threading.Lock()
+		self.prefix = os.path.join(directory, 'nzbToAniDB-{0}-{1}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+
+	def start(self):
+		if self.trace_malloc:
+			tracemalloc.start(self.frames)
+		threading.setprofile(self.thread)
+		self.profile.enable()
+
+	def thread(self, frame, event, arg):
+		# Threads started from now on (the hashing threads) get a profile of
+		# their own, merged at stop(). Since Python 3.12 the main profile
+		# already sees every thread and a second one cannot be enabled.
+		profile = cProfile.Profile()
+		try:
+			profile.enable()
+		except ValueError:
+			return
+		with self.lock:
+			self.threads.append(profile)
+
+	def wrap(self, func, name):
+		# Counts calls, wall time and (with tracemalloc) net allocated bytes for a named marker.
+		marker = self.markers.setdefault(name, [0, 0.0, 0])
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			mem = tracemalloc.get_traced_memory()[0] if self.trace_malloc else 0
+			t = time.perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				seconds = time.perf_counter() - t
+				alloc = tracemalloc.get_traced_memory()[0] - mem if self.trace_malloc else 0
+				with self.lock:
+					marker[0] += 1
+					marker[1] += seconds
+					marker[2] += alloc
+		return wrapper
+
+	def mark(self, cls, attr, name = None):
+		setattr(cls, attr, self.wrap(getattr(cls, attr), name or '{0}.{1}'.format(cls.__name__, attr)))
+
+	def stop(self):
+		self.profile.disable()
+		threading.setprofile(None)
+		stats = pstats.Stats(self.profile)
+		with self.lock:
+			for profile in self.threads:
+				stats.add(profile)
+		os.makedirs(self.directory, exist_ok = True)
+		files = [self.prefix + '.pstats', self.prefix + '-markers.txt']
+		stats.dump_stats(files[0])
+		with open(files[1], 'w') as f:
+			f.write('{0:<20} {1:>8} {2:>12} {3:>14}\n'.format('marker', 'calls', 'seconds', 'alloc bytes'))
+			for name, (calls, seconds, alloc) in sorted(self.markers.items(), key = lambda m: -m[1][1]):
+				f.write('{0:<20} {1:>8} {2:>12.4f} {3:>14}\n'.format(name, calls, seconds, alloc if self.trace_malloc else '-'))
+			f.write('\n')
+			stats.stream = f
+			stats.sort_stats('cumulative').print_stats(30)
+		if self.trace_malloc:
+			snapshot = tracemalloc.take_snapshot()
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			files.append(self.prefix + '-alloc.txt')
+			with open(files[2], 'w') as f:
+				f.write('peak traced memory: {0} bytes\n\n'.format(peak))
+				for stat in snapshot.statistics('lineno')[:25]:
+					f.write('{0}\n'.format(stat))
+		return files
@@ -0,0 +1,60 @@
+import threading, time, heapq, itertools
+
+# fifo: in arrival order, smallest: smallest size first, newest: the job that
+# showed up last first, fair: round robin between jobs.
+policies = ('fifo', 'smallest', 'newest', 'fair')
+
+class Scheduler:
+	# Blocking work queue shared between threads. get() returns None once the
+	# queue is closed and empty.
+	def __init__(self, policy = 'fifo'):
+		if policy not in policies:
+			raise ValueError('unknown schedule policy: {0}'.format(policy))
+		self.policy = policy
+		self.cond = threading.Condition()
+		self.heap = []
+		self.seq = itertools.count()
+		self.jobs = {}
+		self.vtime = 0
+		self.closed = False
+		self.max_depth = 0
+
+	def key(self, size, job):
+		seq = next(self.seq)
+		if self.policy == 'smallest':
+			return (size, seq)
+		if self.policy == 'newest':
+			return (-self.jobs.setdefault(job, seq), seq)
+		if self.policy == 'fair':
+			# A job that joins late starts at the current round, it does not
+			# get to catch up on the rounds it missed.
+			n = max(self.jobs.get(job, 0), self.vtime)
+			self.jobs[job] = n + 1
+			return (n, seq)
+		return (seq,)
+
+	def put(self, item, size = 0, job = None):
+		with self.cond:
+			heapq.heappush(self.heap, (self.key(size, job), time.perf_counter(), item))
+			self.max_depth = max(self.max_depth, len(self.heap))
+			self.cond.notify()
+
+	def get(self):
+		# Returns (item, seconds queued, items still waiting).
+		with self.cond:
+			while not self.heap and not self.closed:
+				self.cond.wait()
+			if not self.heap:
+				return None
+			key, t, item = heapq.heappop(self.heap)
+			if self.policy == 'fair':
+				self.vtime = key[0]
+			return item, time.perf_counter() - t, len(self.heap)
+
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+
+	def __len__(self):
+		return len(self.heap)
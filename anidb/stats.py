@@ -0,0 +1,96 @@
+import time, json, os
+from contextlib import contextmanager
+
+class Stats:
+	def __init__(self, logfile = None):
+		self.log = open(logfile, 'a') if logfile else None
+		self.records = []
+		self.start = time.time()
+
+	def record(self, stage, file = None, seconds = 0.0, **fields):
+		rec = {'time': time.time(), 'stage': stage, 'file': str(file) if file is not None else None, 'seconds': seconds}
+		rec.update(fields)
+		self.records.append(rec)
+		if self.log:
+			self.log.write(json.dumps(rec) + '\n')
+			self.log.flush()
+		return rec
+
+	@contextmanager
+	def span(self, stage, file = None, anidb = None, **fields):
+		# With an AniDB client, the time spent in its throttle is split from the round trips.
+		if anidb:
+			wait, rtt = anidb.wait_time, anidb.rtt_time
+		t = time.perf_counter()
+		try:
+			yield fields
+		finally:
+			if anidb:
+				fields['wait'] = anidb.wait_time - wait
+				fields['rtt'] = anidb.rtt_time - rtt
+			self.record(stage, file, time.perf_counter() - t, **fields)
+
+	def stages(self):
+		stages = {}
+		for rec in self.records:
+			s = stages.setdefault(rec['stage'], {'count': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0, 'wait': 0.0, 'rtt': 0.0, 'hits': 0, 'depth': 0})
+			s['count'] += 1
+			s['seconds'] += rec['seconds']
+			s['max'] = max(s['max'], rec['seconds'])
+			s['bytes'] += rec.get('bytes', 0)
+			s['wait'] += rec.get('wait', 0.0)
+			s['rtt'] += rec.get('rtt', 0.0)
+			s['hits'] += bool(rec.get('cached'))
+			s['depth'] = max(s['depth'], rec.get('depth', 0))
+		return stages
+
+	def summary(self):
+		lines = ['{0:<10} {1:>6} {2:>10} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9} {8:>6} {9:>6}'.format('stage', 'count', 'total s', 'mean s', 'max s', 'MB/s', 'wait s', 'rtt s', 'cached', 'depth')]
+		for name, s in self.stages().items():
+			# Cached files were not read, their bytes would inflate the rate.
+			hashed = sum(r['seconds'] for r in self.records if r['stage'] == name and r.get('bytes') and not r.get('cached'))
+			hashed_bytes = sum(r['bytes'] for r in self.records if r['stage'] == name and r.get('bytes') and not r.get('cached'))
+			lines.append('{0:<10} {1:>6} {2:>10.3f} {3:>9.3f} {4:>9.3f} {5:>9} {6:>9} {7:>9} {8:>6} {9:>6}'.format(
+				name, s['count'], s['seconds'], s['seconds'] / s['count'], s['max'],
+				'{0:.1f}'.format(hashed_bytes / hashed / 1e6) if hashed else '-',
+				'{0:.3f}'.format(s['wait']) if s['wait'] or s['rtt'] else '-',
+				'{0:.3f}'.format(s['rtt']) if s['wait'] or s['rtt'] else '-',
+				s['hits'] if name == 'hash' else '-',
+				s['depth'] if name.endswith('-queue') else '-'))
+		lines.append('total run time: {0:.3f} s'.format(time.time() - self.start))
+		return '\n'.join(lines)
+
+	def write_prometheus(self, path):
+		# Written to a temporary file and renamed, so the node exporter never reads half a file.
+		out = [
+			'# HELP nzbtoanidb_last_run_timestamp_seconds End of the last run.',
+			'# TYPE nzbtoanidb_last_run_timestamp_seconds gauge',
+			'nzbtoanidb_last_run_timestamp_seconds {0:.3f}'.format(time.time()),
+			'# HELP nzbtoanidb_last_run_duration_seconds Duration of the last run.',
+			'# TYPE nzbtoanidb_last_run_duration_seconds gauge',
+			'nzbtoanidb_last_run_duration_seconds {0:.3f}'.format(time.time() - self.start),
+			]
+		metrics = (
+			('stage_count', 'count', 'Spans per stage in the last run.'),
+			('stage_seconds', 'seconds', 'Time spent per stage in the last run.'),
+			('stage_bytes', 'bytes', 'Bytes handled per stage in the last run.'),
+			('stage_wait_seconds', 'wait', 'AniDB throttle wait per stage in the last run.'),
+			('stage_rtt_seconds', 'rtt', 'AniDB round trip time per stage in the last run.'),
+			('stage_cache_hits', 'hits', 'Cached results per stage in the last run.'),
+			('stage_queue_depth_max', 'depth', 'Most items waiting behind a queue stage in the last run.'),
+			)
+		stages = self.stages()
+		for metric, field, help in metrics:
+			out.append('# HELP nzbtoanidb_{0} {1}'.format(metric, help))
+			out.append('# TYPE nzbtoanidb_{0} gauge'.format(metric))
+			for name, s in stages.items():
+				out.append('nzbtoanidb_{0}{{stage="{1}"}} {2}'.format(metric, name, s[field]))
+		tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+		with open(tmp, 'w') as f:
+			f.write('\n'.join(out) + '\n')
+		os.replace(tmp, path)
+
+	def close(self):
+		if self.log:
+			self.log.close()
+			self.log = None
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+# Guesses the anime of a release from its name, with an index of the AniDB
+# title dump (anime-titles.dat.gz, lines of aid|type|language|title):
+#
+#   python -m anidb.titles --database nzbToAniDB.db anime-titles.dat.gz
+#
+# AniDB bans clients fetching the dump more than once a day, so it is not
+# downloaded here.
+
+import optparse, os, re, gzip, collections, sqlite3
+from anidb.cache import Database
+
+Guess = collections.namedtuple('Guess', 'group title episode')
+
+tag = re.compile(r'\s*[\[(][^\])]*[\])]\s*')
+episode_patterns = (
+	# Title - 05v2, Title - S1 (special), Title - 05-06
+	re.compile(r'^(?P<title>.+?)\s+-\s+(?P<episode>S?\d{1,4}(?:-S?\d{1,4})?)(?:v\d+)?(?:\s|$)', re.I),
+	# Title S01E05 (the season is left to the title lookup)
+	re.compile(r'^(?P<title>.+?)\s+S\d{1,2}E(?P<episode>\d{1,4})(?:v\d+)?(?:\s|$)', re.I),
+	# Title Ep05, Title 05
+	re.compile(r'^(?P<title>.+?)\s+(?:Ep?\.?\s*|Episode\s+)?(?P<episode>\d{1,4})(?:v\d+)?(?:\s|$)', re.I),
+	)
+
+def parse(name):
+	# [Group] Title - 05v2 [1080p][ABCD1234].mkv -> Guess('Group', 'Title', '05')
+	stem = os.path.splitext(os.path.basename(name))[0]
+	group = None
+	m = re.match(r'\s*[\[(]([^\])]+)[\])]', stem)
+	if m:
+		group = m.group(1).strip()
+		stem = stem[m.end():]
+	stem = tag.sub(' ', stem).replace('_', ' ')
+	if ' ' not in stem.strip():
+		stem = stem.replace('.', ' ')
+	stem = ' '.join(stem.split())
+	for pattern in episode_patterns:
+		m = pattern.match(stem)
+		if m:
+			return Guess(group, m.group('title').strip(' -'), m.group('episode').upper())
+	return Guess(group, stem.strip(' -'), None) if stem.strip(' -') else None
+
+def normalize(title):
+	return re.sub(r'[\W_]+', '', title.lower())
+
+# Title types of the dump, the better match first: main, official, synonym, short.
+priority = {1: 0, 4: 1, 2: 2, 3: 3}
+
+class Titles(Database):
+	schema = '''
+		CREATE TABLE IF NOT EXISTS title (
+			aid INTEGER NOT NULL,
+			type INTEGER NOT NULL,
+			lang TEXT NOT NULL,
+			title TEXT NOT NULL,
+			norm TEXT NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS title_norm ON title (norm);
+	'''
+
+	def __init__(self, path):
+		Database.__init__(self, path)
+		self.db.row_factory = sqlite3.Row
+
+	def load(self, lines):
+		# Replaces the index with the titles of a dump, returns their number.
+		rows = []
+		for line in lines:
+			if line.startswith('#') or line.count('|') < 3:
+				continue
+			aid, kind, lang, title = line.rstrip('\r\n').split('|', 3)
+			rows.append((int(aid), int(kind), lang, title, normalize(title)))
+		with self.db:
+			self.db.execute('DELETE FROM title')
+			self.db.executemany('INSERT INTO title VALUES (?, ?, ?, ?, ?)', rows)
+		return len(rows)
+
+	def lookup(self, title):
+		# Anime ids with exactly this title, the most likely first.
+		rows = self.db.execute('SELECT aid, type FROM title WHERE norm = ?', (normalize(title),)).fetchall()
+		best = {}
+		for row in rows:
+			best[row['aid']] = min(best.get(row['aid'], 9), priority.get(row['type'], 9))
+		return sorted(best, key = lambda aid: (best[aid], aid))
+
+	def __len__(self):
+		return self.db.execute('SELECT COUNT(*) FROM title').fetchone()[0]
+
+def main():
+	op = optparse.OptionParser(usage = 'python -m anidb.titles [options] anime-titles.dat[.gz]')
+	op.add_option('-d', '--database', default = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nzbToAniDB.db'), help = 'Local database (default: next to nzbToAniDB.py).')
+	op.add_option('-g', '--guess', action = 'store_true', help = 'Show the guesses for the given release names instead.')
+	options, args = op.parse_args()
+	if not args:
+		op.error('a title dump is required')
+	titles = Titles(options.database)
+	if options.guess:
+		for name in args:
+			guess = parse(name)
+			print('{0}: {1} -> {2}'.format(name, guess, guess and titles.lookup(guess.title)))
+		return
+	opener = gzip.open if args[0].endswith('.gz') else open
+	with opener(args[0], 'rt', encoding = 'utf-8') as f:
+		print('Imported {0} titles.'.format(titles.load(f)))
+
+if __name__ == '__main__':
+	main()
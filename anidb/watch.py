@@ -0,0 +1,113 @@
+import os, struct, select, time, ctypes, ctypes.util
+
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+event = struct.Struct('iIII')
+
+class WatchError(OSError):
+	pass
+
+class Watcher:
+	# Reports files in the watched trees once they were closed after writing
+	# (or moved in) and have not changed for `settle` seconds.
+	mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+	def __init__(self, paths, settle = 30, scan = False):
+		# scan: files already in the trees are reported too.
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise WatchError(ctypes.get_errno(), 'inotify_init1 failed')
+		self.settle = settle
+		self.dirs = {}
+		self.pending = {}
+		for path in paths:
+			self.add_tree(str(path), scan)
+
+	def add(self, path):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+		if wd < 0:
+			raise WatchError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+		self.dirs[wd] = path
+
+	def add_tree(self, path, scan = False):
+		# Directories created or moved in are watched too; files already in
+		# a moved directory never get an event of their own, so they are queued.
+		now = time.time()
+		for root, dirs, files in os.walk(path):
+			self.add(root)
+			if scan:
+				for name in files:
+					self.pending[os.path.join(root, name)] = now
+
+	def read(self):
+		try:
+			data = os.read(self.fd, 65536)
+		except BlockingIOError:
+			return
+		pos = 0
+		while pos < len(data):
+			wd, mask, cookie, length = event.unpack_from(data, pos)
+			name = data[pos + event.size:pos + event.size + length].rstrip(b'\0')
+			pos += event.size + length
+			yield wd, mask, os.fsdecode(name)
+
+	def handle(self, wd, mask, name):
+		now = time.time()
+		if mask & IN_Q_OVERFLOW:
+			# Events were lost, fall back to a scan of everything watched.
+			for path in list(self.dirs.values()):
+				for entry in os.scandir(path):
+					if entry.is_file():
+						self.pending[entry.path] = now
+			return
+		if mask & (IN_IGNORED | IN_DELETE_SELF):
+			self.dirs.pop(wd, None)
+			return
+		if wd not in self.dirs or not name:
+			return
+		path = os.path.join(self.dirs[wd], name)
+		if mask & IN_ISDIR:
+			if mask & (IN_CREATE | IN_MOVED_TO) and os.path.isdir(path):
+				self.add_tree(path, scan = True)
+		elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+			self.pending[path] = now
+		elif mask & IN_MODIFY and path in self.pending:
+			# Written again, the quiet period starts over.
+			self.pending[path] = now
+
+	def batches(self, deadline = lambda: None):
+		# deadline() gives the seconds until the caller wants to be woken up,
+		# an empty batch is yielded then.
+		while 1:
+			now = time.time()
+			timeout = min([t + self.settle - now for t in self.pending.values()] + [d for d in [deadline()] if d is not None], default = None)
+			if select.select([self.fd], [], [], max(timeout, 0) if timeout is not None else None)[0]:
+				for wd, mask, name in self.read():
+					self.handle(wd, mask, name)
+			now = time.time()
+			settled = sorted(p for p, t in self.pending.items() if now - t >= self.settle)
+			for path in settled:
+				del self.pending[path]
+			settled = [p for p in settled if os.path.isfile(p)]
+			if settled or deadline() == 0:
+				yield settled
+
+	def requeue(self, paths, delay = 0):
+		# Reports the files again once they were quiet for delay + settle seconds.
+		later = time.time() + delay
+		for path in paths:
+			self.pending[str(path)] = later
+
+	def close(self):
+		os.close(self.fd)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+# Hashing worker for files that live on another host.
+#
+# The worker hashes files on its own disks and answers over TCP, one JSON
+# object per line:
+#
+#   -> {"path": "/data/anime/a.mkv", "algorithms": ["ed2k"], "cache": true}
+#   <- {"path": "/data/anime/a.mkv", "size": 123, "mtime": 1.0, "ed2k": "...", "cached": false, "hashtime": 1.2}
+#   <- {"path": "/data/anime/a.mkv", "error": "..."}
+#
+#   python -m anidb.worker --root /data/anime --port 9100
+
+import optparse, os, json, socket, socketserver
+import anidb.hash
+
+class WorkerError(OSError):
+	pass
+
+class Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			request = None
+			try:
+				request = json.loads(line)
+				path = os.path.realpath(request['path'])
+				if not any(path == root or path.startswith(root + os.sep) for root in self.server.roots):
+					raise WorkerError('outside of the worker roots')
+				algorithms = [a for a in request.get('algorithms', ['ed2k']) if a in anidb.hash.hasher_obj]
+				f = anidb.hash.File(path, algorithms, request.get('cache', False) and self.server.cache, self.server.blocksize, self.server.iomode)
+				reply = {'path': request['path'], 'size': f.size, 'mtime': f.mtime, 'cached': f.cached, 'hashtime': f.hashtime}
+				for a in algorithms:
+					reply[a] = getattr(f, a)
+			except (OSError, ValueError, KeyError) as e:
+				reply = {'path': request.get('path') if isinstance(request, dict) else None, 'error': str(e)}
+			self.wfile.write(json.dumps(reply).encode() + b'\n')
+			self.wfile.flush()
+
+class Server(socketserver.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+	def __init__(self, address, roots, cache = False, blocksize = 131072, iomode = 'buffered'):
+		self.roots = [os.path.realpath(r) for r in roots]
+		self.cache = cache and anidb.hash.xattr is not None
+		self.blocksize = blocksize
+		self.iomode = iomode
+		socketserver.ThreadingTCPServer.__init__(self, address, Handler)
+
+class RemoteFile:
+	# Same attributes as anidb.hash.File, filled in by a worker.
+	def __init__(self, name, address, remote_path, algorithms, cache):
+		with socket.create_connection(address, timeout = 10) as sock:
+			# Only connecting is timed, hashing a large file takes a while.
+			sock.settimeout(None)
+			sock.sendall(json.dumps({'path': remote_path, 'algorithms': list(algorithms), 'cache': bool(cache)}).encode() + b'\n')
+			reply = json.loads(sock.makefile('rb').readline() or b'{"error": "connection closed"}')
+		if 'error' in reply:
+			raise WorkerError('{0}:{1}: {2}: {3}'.format(address[0], address[1], remote_path, reply['error']))
+		self.name = name
+		self.size = reply['size']
+		self.mtime = reply['mtime']
+		self.cached = reply['cached']
+		self.hashtime = reply['hashtime']
+		self.worker = address
+		for a in algorithms:
+			setattr(self, a, reply[a])
+
+class Dispatcher:
+	# Sends files below a mapped prefix to the worker owning that storage and
+	# hashes everything else locally, as well as files a worker could not
+	# hash. mapping: local prefix -> (address, remote prefix)
+	def __init__(self, mapping):
+		self.mapping = sorted(((os.path.abspath(p), w) for p, w in mapping.items()), key = lambda m: -len(m[0]))
+
+	@classmethod
+	def from_config(cls, section):
+		# "nas = storage:9100 /mnt/nas/anime /data/anime", the remote prefix defaults to the local one.
+		mapping = {}
+		for name, value in section.items():
+			parts = value.split()
+			host, port = parts[0].rsplit(':', 1)
+			mapping[parts[1]] = ((host, int(port)), parts[2] if len(parts) > 2 else parts[1])
+		return cls(mapping)
+
+	def __call__(self, name, algorithms, cache, blocksize = 131072, iomode = 'buffered'):
+		path = os.path.abspath(name)
+		for prefix, (address, remote) in self.mapping:
+			if path == prefix or path.startswith(prefix + os.sep):
+				try:
+					return RemoteFile(name, address, remote + path[len(prefix):], algorithms, cache)
+				except (OSError, ValueError, KeyError) as e:
+					print('Worker failed, hashing locally: {0}'.format(e))
+				break
+		return anidb.hash.File(name, algorithms, cache, blocksize, iomode)
+
+def main():
+	op = optparse.OptionParser(usage = 'python -m anidb.worker --root DIR [options]')
+	op.add_option('-r', '--root', action = 'append', default = [], help = 'Directory the worker may hash files in (repeatable).')
+	op.add_option('-b', '--bind', default = '127.0.0.1', help = 'Address to listen on.')
+	op.add_option('-p', '--port', type = 'int', default = 9100, help = 'Port to listen on.')
+	op.add_option('-c', '--cache', action = 'store_true', help = 'Use and write the xattr hash cache.')
+	op.add_option('-i', '--iomode', default = 'buffered', choices = anidb.hash.io_modes, help = 'How files are read, see anidb.hash.io_modes.')
+	op.add_option('-s', '--blocksize', type = 'int', default = 131072, help = 'Bytes per read.')
+	op.add_option('-R', '--rate', type = 'float', default = 0, help = 'Cap reads at this many MB/s.')
+	options, args = op.parse_args()
+	if not options.root:
+		op.error('at least one --root is required')
+	anidb.hash.limit(options.rate * 1e6)
+	server = Server((options.bind, options.port), options.root, options.cache, options.blocksize, options.iomode)
+	print('Hashing worker on {0}:{1} for {2}'.format(options.bind, server.server_address[1], ', '.join(server.roots)))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
+
+if __name__ == '__main__':
+	main()
@@ -18,12 +18,12 @@
 # NOTE: This script requires Python to be installed on your system.
 ### NZBGET POST-PROCESSING SCRIPT                                          ###
 ##############################################################################
-import optparse, os, sys, getpass, shutil, urllib, time, json
+# Keep startup cheap: anidb.hash, tvdb and the HTTP/XML modules are imported
+# once a run is known to have work to do.
+import os, sys, re, time, threading
 from pathlib import Path
-from collections import deque
-import anidb, anidb.hash
-import tvdb
-from datetime import datetime
+from itertools import chain
+import anidb, anidb.stats
 import configparser
 import unicodedata, string
 
@@ -34,14 +34,117 @@ def remove_disallowed_filename_chars(filename):
     cleanedFilename = unicodedata.normalize('NFKD', str(filename))#.encode('ASCII', 'ignore')
     return ''.join([c for c in cleanedFilename if c in validFilenameChars])
 
+class Duplicate(Exception):
+    pass
+
+class Offline(Exception):
+    # reason: the deferred queue backoff, 'timeout' or 'banned'.
+    def __init__(self, reason = 'timeout'):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+def tvdb_episodes(t, sep = '-'):
+    eps = t['tvdbepnum']
+    return eps[0] if len(eps) == 1 else eps[0] + sep + eps[-1]
+
+# Template tags: the AniDB file fields they need and how they are rendered.
+# A tag rendering to None (TVDB tags without a TVDB match) stays as it is.
+tags = {
+    #Anime title, r: romaji, e: english, k: kanji
+    'ATr': (('romaji',), lambda i, f, t: i.romaji),
+    'ATe': (('english', 'romaji'), lambda i, f, t: i.english or i.romaji),
+    'ATk': (('kanji',), lambda i, f, t: i.kanji),
+    #Episode title, languages as above
+    'ETr': (('epromaji',), lambda i, f, t: i.epromaji),
+    'ETe': (('epname',), lambda i, f, t: i.epname),
+    'ETk': (('epkanji',), lambda i, f, t: i.epkanji),
+    #Group title, s: short, l: long
+    'GTs': (('gtag',), lambda i, f, t: i.gtag),
+    'GTl': (('gname',), lambda i, f, t: i.gname),
+    'EpHiNo': (('eplast',), lambda i, f, t: str(i.eplast)), #Highest (subbed) episode number
+    'EpCount': (('eptotal',), lambda i, f, t: str(i.eptotal)), #Anime Episode count
+    'AYearBegin': (('year',), lambda i, f, t: i.year.split('-')[0]),
+    'AYearEnd': (('year',), lambda i, f, t: i.year.split('-')[1] if i.year.find('-') > 0 else ''), #The beginning & ending year of the anime
+    'EpNo': (('epno',), lambda i, f, t: i.epno if len(i.epno) > 1 else '0' + i.epno), #File's Episode number
+    'Type': (('type',), lambda i, f, t: i.type), #Anime type, Value: 'Movie', 'TV', 'OVA', 'Web'
+    'Depr': (('depr',), lambda i, f, t: str(i.depr)), #File is deprecated if the value is '1'
+    'Cen': (('state',), lambda i, f, t: 'censored' if i.censored else ''), #File is censored
+    'Ver': (('state',), lambda i, f, t: 'v{0}'.format(i.version) if i.version > 1 else ''), #File version
+    'Source': (('source',), lambda i, f, t: i.source), #Where the file came from (HDTV, DTV, WWW, etc)
+    'Quality': (('quality',), lambda i, f, t: i.quality), #How good the quality of the file is (Very Good, Good, Eye Cancer)
+    'CurrentFN': ((), lambda i, f, t: f.name.name), #Current Filename
+    'FCrc': (('crc32',), lambda i, f, t: i.crc32), #The file's crc
+    'FCRC': (('crc32',), lambda i, f, t: i.crc32.upper()),
+    'FVideoRes': (('vres',), lambda i, f, t: i.vres), #Video Resolution (e.g. 1920x1080)
+    'FALng': (('dublang',), lambda i, f, t: i.dublang), #List of available audio languages (japanese, english'japanese'german)
+    'FSLng': (('sublang',), lambda i, f, t: i.sublang), #List of available subtitle languages (japanese, english'japanese'german)
+    'FACodec': (('acodec',), lambda i, f, t: i.acodec), #Codecs used for the Audiostreams
+    'FVCodec': (('vcodec',), lambda i, f, t: i.vcodec), #Codecs used for the Videostreams
+    'suf': (('filetype',), lambda i, f, t: i.filetype),
+    #tvdb
+    'TSTe': ((), lambda i, f, t: t and t['tvdbseriesname']),
+    'TETe': ((), lambda i, f, t: t and t['tvdbepname']),
+    'TS': ((), lambda i, f, t: t and t['tvdbseason']),
+    'TE': ((), lambda i, f, t: t and tvdb_episodes(t)),
+    'TSE': ((), lambda i, f, t: t and 'S' + t['tvdbseason'] + 'E' + tvdb_episodes(t, '-E')),
+}
+tag_re = re.compile(r'%(\w+)%')
+default_format = '%ATe% - %EpNo%%Ver% - %ETe% [%GTs%][%FCRC%]'
+default_folder = '%ATe%'
+
+def render(template, info, file, tvdbinfo = None):
+    def tag(m):
+        value = tags[m.group(1)][1](info, file, tvdbinfo) if m.group(1) in tags else None
+        return m.group(0) if value is None else value
+    return tag_re.sub(tag, template)
+
+def file_fields():
+    # Only what the enabled features and configured templates use goes into the FILE masks.
+    fields = {'aid', 'type'}
+    if options.identify:
+        fields.update(('gtag', 'romaji', 'english', 'epno', 'epromaji', 'epname'))
+    if options.tvdb:
+        fields.add('epno')
+    if options.index:
+        fields.update(anidb.index.LibraryIndex.fields)
+    if options.mylistage and (options.add or options.watched):
+        # Fills the local mylist mirror on the way.
+        fields.update(('lid', 'mystate', 'viewed'))
+    if options.rename or options.move:
+        templates = [default_format, default_folder]
+        for key, value in config["rename"].items():
+            if options.tvdb or not key.startswith('tvdb'):
+                templates.append(value)
+        for name in tag_re.findall(' '.join(templates)):
+            if name in tags:
+                fields.update(tags[name][0])
+        if options.rename:
+            fields.add('filetype')
+    return fields
+
 class Options:
     def __init__(self, config):
         self.username = config["AniDB"].get("username", None)
         self.password = config["AniDB"].get("password", None)
         self.recursive = config["AniDB"].getboolean("recursiv", True)
-        self.suffix = [s.lower() for s in config["AniDB"].get("suffix", "avi ogm mkv mp4 wmv m4v").split(" ")]
+        self.suffix = {s.lower() for s in config["AniDB"].get("suffix", "avi ogm mkv mp4 wmv m4v").split()}
+        self.skip = config["AniDB"].get("skip", "").split()
         self.cache = config["AniDB"].getboolean("cache", True)
+        self.cacheage = config["AniDB"].getfloat("cacheage", 7)
+        self.mylistage = config["AniDB"].getfloat("mylistage", 30)
+        self.threads = config["AniDB"].getint("threads", 1)
+        self.schedule = config["AniDB"].get("schedule", "fifo")
+        self.iomode = config["AniDB"].get("iomode", "buffered")
+        self.blocksize = config["AniDB"].getint("blocksize", 131072)
+        self.ratelimit = config["AniDB"].getfloat("ratelimit", 0)
+        self.index = config["AniDB"].getboolean("index", False)
+        self.replace = config["AniDB"].getboolean("replace", False)
+        self.settle = config["AniDB"].getfloat("settle", 30)
+        self.batch = config["AniDB"].getint("batch", 100)
+        self.defer = config["AniDB"].getboolean("defer", True)
+        self.deferlimit = config["AniDB"].getint("deferlimit", 50)
         self.tvdb = config["AniDB"].getboolean("tvdb", False)
+        self.prefetch = config["AniDB"].getboolean("prefetch", True)
         self.multihash = config["AniDB"].getboolean("multihash", False)
         self.identify = config["AniDB"].getboolean("identify", False)
         self.add = config["AniDB"].getboolean("add", False)
@@ -49,60 +152,424 @@ class Options:
         self.rename = config["AniDB"].getboolean("rename", False)
         self.move = config["AniDB"].getboolean("move", False)
         self.delete = config["AniDB"].getboolean("delete", False)
+        self.placement = config["AniDB"].get("placement", "move")
         self.directory = Path(config["AniDB"].get("directory", None))
         self.directorymovie = Path(config["AniDB"].get("directorymovie", None))
         self.update = config["AniDB"].getboolean("update", False)
+        self.debounce = config["AniDB"].getfloat("debounce", 60)
         self.color = config["AniDB"].getboolean("color", True)
+        self.compress = config["AniDB"].getboolean("compress", False)
+        self.database = Path(config["AniDB"].get("database", "") or Path(__file__).parent / "nzbToAniDB.db")
+        self.stats = config["AniDB"].getboolean("stats", False)
+        self.statslog = config["AniDB"].get("statslog", "")
+        self.promfile = config["AniDB"].get("promfile", "")
+        self.profile = os.environ.get("NZBTOANIDB_PROFILE", "") not in ("", "0") or config["AniDB"].getboolean("profile", False)
+        self.profiledir = config["AniDB"].get("profiledir", "") or "."
+        self.tracemalloc = os.environ.get("NZBTOANIDB_TRACEMALLOC", "") not in ("", "0") or config["AniDB"].getboolean("tracemalloc", False)
         self.login = False
         
-def get_files(paths):
-    files = []
-    remaining = deque(paths)
-    while remaining:
-        name = remaining.popleft()
+def name_filters():
+    # Which directories are walked into and which files are picked, the
+    # same for scans and for files the watcher reports.
+    hidden = os.name == "posix"
+    suffix = options.suffix
+    skip = None
+    if options.skip:
+        import fnmatch
+        skip = re.compile('|'.join(fnmatch.translate(p.lower()) for p in options.skip)).match
+    def directory(name):
+        return not (hidden and name.startswith('.')) and not (skip and skip(name.lower()))
+    def file(name):
+        return not (hidden and name.startswith('.')) and name.rpartition('.')[2].lower() in suffix
+    return directory, file
+
+def scan_files(paths):
+    # os.scandir hands out the entry type from the directory listing, so
+    # only the entries that are yielded ever cost a stat.
+    directory, file = name_filters()
+    for name in paths:
         if not os.access(name, os.R_OK):
             print('{0} {1}'.format(red('Invalid file:'), name))
         elif name.is_file():
-            files.append(name)
+            yield name
         elif name.is_dir():
             if not options.recursive:
                 print('{0} {1}'.format(red('Is a directory:'), name))
-            else:
-                for sub in name.iterdir():
-                    if os.name == "posix" and sub.parts[-1].startswith('.'):
-                        continue
-                    if sub.is_file() and sub.suffix[1:].lower() in options.suffix:
-                        files.append(sub)
-                    elif sub.is_dir():
-                        remaining.appendleft(sub)
+                continue
+            remaining = [str(name)]
+            while remaining:
+                try:
+                    entries = os.scandir(remaining.pop())
+                except OSError as e:
+                    print('{0} {1}'.format(red('Invalid file:'), e.filename))
+                    continue
+                subdirs = []
+                with entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            if file(entry.name):
+                                yield Path(entry.path)
+                        elif entry.is_dir():
+                            if directory(entry.name):
+                                subdirs.append(entry.path)
+                remaining.extend(reversed(subdirs))
+
+def watched_files(paths):
+    # Settled files from the watcher, picked as a scan of the watched folders would.
+    directory, file = name_filters()
+    for name in map(Path, paths):
+        root = next((root for root in target_path if root in name.parents), None)
+        folders = name.parent.relative_to(root).parts if root else ()
+        if folders and not options.recursive:
+            continue
+        if file(name.name) and all(directory(folder) for folder in folders):
+            yield name
 
-    if not files:
+def get_files(paths):
+    files = scan_files(paths)
+    first = next(files, None)
+    if first is None:
         print(blue('Nothing to do.'))
         sys.exit(0)
-    return files
+    return chain((first,), files)
+
+def get_tvdb():
+    global mytvdb
+    with tvdb_lock:
+        if mytvdb is None:
+            import tvdb
+            mytvdb = tvdb.TvDB(Path(__file__).parent / "anime-list.xml")
+    return mytvdb
+
+def tvdb_lookup(aid, epno):
+    # Results are kept for the run, the prefetch may have asked already.
+    key = (aid, epno.lstrip('0'))
+    if key not in tvdb_results:
+        tvdb_results[key] = get_tvdb().find_tvdb(aid, epno)
+    return tvdb_results[key]
+
+def prefetch(name):
+    # Runs beside hashing: guesses the anime and episode from the file name
+    # and looks up the TVDB mapping for it. A wrong guess only leaves an
+    # unused entry in tvdb_results, AniDB is never asked.
+    guess = anidb.titles.parse(name)
+    aids = guess and guess.episode and titles.lookup(guess.title)
+    if aids:
+        with stats.span('prefetch', name):
+            tvdb_lookup(str(aids[0]), guess.episode)
+
+def prefetching(files):
+    for name in files:
+        prefetcher.submit(prefetch, name)
+        yield name
+
+def job_of(name):
+    # A job is what a download client drops into a watched or given folder:
+    # the entry directly below it, or the given path itself.
+    name = Path(name)
+    for root in target_path:
+        if root in name.parents:
+            return root / name.relative_to(root).parts[0]
+    return name.parent
 
 def login():
-    a = anidb.AniDB(options.username, options.password)
-    try:
-        a.auth()
-        print('{0} {1}'.format(blue('Logged in as user:'), options.username))
-    except anidb.AniDBUserError:
-        print(red('Invalid username/password.'))
-        sys.exit(0)
-    except anidb.AniDBTimeout:
-        print(red('Connection timed out.'))
-        sys.exit(0)
-    except anidb.AniDBError as e:
-        print('{0} {1}'.format(red('Fatal error:'), e))
-        sys.exit(0)
-    return a
+    # Nothing is sent here: the client logs in with the first request the
+    # caches cannot answer, see identify() and place() for its errors.
+    import anidb.cache
+    mylist = None
+    if options.mylistage:
+        import anidb.mylist
+        mylist = anidb.mylist.Mylist(options.database)
+    return anidb.AniDB(options.username, options.password, compress = options.compress, cache = anidb.cache.Cache(options.database), cache_age = options.cacheage * 86400,
+                       mylist = mylist, mylist_age = options.mylistage * 86400)
+
+def identify(fid):
+    # With the deferred queue, a timeout parks the rest of the run instead
+    # of waiting for AniDB to come back.
+    global a
+    if a is None:
+        raise Offline(outage)
+    if deferred is None:
+        return a.get_file(fid, True, fields)
+    for attempt in (0, 1):
+        try:
+            return a.get_file(fid, False, fields)
+        except anidb.AniDBTimeout:
+            pass
+        except anidb.AniDBUnavailable as e:
+            raise go_offline(offline_reason(e))
+    raise go_offline('timeout')
+
+def offline_reason(e):
+    # The deferred queue backoff for an error that took AniDB away.
+    if isinstance(e, Offline):
+        return e.reason
+    if isinstance(e, anidb.AniDBUnavailable) and e.code == anidb.BANNED:
+        return 'banned'
+    return 'timeout'
+
+def go_offline(reason):
+    # AniDB is left alone, no login either, until the first retry of the
+    # files parked for this reason is due. Returns the exception to raise.
+    global a, relogin, outage
+    import anidb.deferred
+    a = None
+    outage = reason
+    relogin = time.time() + anidb.deferred.backoff[reason][0]
+    return Offline(reason)
+
+def due():
+    # Deferred files to retry along with new ones, at most deferlimit per run.
+    if deferred is None or a is None:
+        return []
+    return deferred.due(options.deferlimit, retry)
+
+def plan_target(file, info, tvdbinfo):
+    # Renders the target path, nothing on disk is touched here.
+    rename = config["rename"]
+
+    if options.rename:
+
+        if tvdbinfo:
+            s = rename['tvdbepisodeformat']
+        elif (info.type == 'Movie' and rename['movieformat']):
+            s = rename['movieformat']
+        elif (info.type == 'OVA' and rename['ovaformat']):
+            s = rename['ovaformat']
+        elif (rename['tvformat']):
+            s = rename['tvformat']
+        else:
+            s = default_format
+
+        s = render(s, info, file, tvdbinfo) + '.' + info.filetype
+
+        # change spaces to underscores, if first character in s is an underscore
+        if s[0] == '_':
+            s = s[1:].replace(' ', '_')
+
+    if options.move:
+
+        if tvdbinfo:
+            f = rename['tvdbfoldername']
+            if int(tvdbinfo['tvdbseason']) > 0:
+                fs = rename['tvdbseasonfolder']
+            else:
+                fs = rename['tvdbspecialsfolder']
+        elif (info.type == "Movie" and rename['foldernamemovie']):
+            f = rename['foldernamemovie']
+            fs = None
+        elif (rename['foldername']):
+            f = rename['foldername']
+            fs = None
+        else:
+            f = default_folder
+            fs = None
+
+        f = render(f, info, file, tvdbinfo)
+
+        if fs:
+            fs = render(fs, info, file, tvdbinfo)
+
+        # change spaces to underscores, if first character in s is an underscore
+        if f[0] == '_':
+            f = f[1:].replace(' ', '_')
+        if fs and fs[0] == '_':
+            fs = fs[1:].replace(' ', '_')
+
+    filename = file.name.name
+    path = file.name.parent
+
+    if options.rename:
+        filename = remove_disallowed_filename_chars(s)
+
+        while filename.startswith('.'):
+            filename = filename[1:]
+        print('{0} {1}'.format(yellow('Renaming to:'), filename))
+
+    if options.move:
+        subdir = remove_disallowed_filename_chars(f)
+        while subdir.startswith('.'):
+            subdir = subdir[1:]
+
+        if (options.directorymovie and info.type == 'Movie'):
+            target_directory = options.directorymovie
+        else:
+            target_directory = options.directory
+
+        if fs:
+            seasondir = remove_disallowed_filename_chars(fs)
+            while seasondir.startswith('.'):
+                seasondir = seasondir[1:]
+            subdir = Path(subdir, seasondir)
+
+        path = target_directory / subdir
+        print('{0} {1}'.format(yellow('Moving to:'), path))
+
+    #failsave against long filenames
+    #if len(target) > 255:
+    #    target = target[:250].strip() + target[-4:]
+
+    return path / filename
+
+def get_notifier():
+    import anidb.notify
+    servers = []
+    if config.has_section("plex") and config["plex"].get("host"):
+        plex = config["plex"]
+        servers.append(anidb.notify.Plex(plex["host"], plex.get("port") or 32400, plex.get("token", ""), plex.get("sections", ""),
+                                         ((options.directory, plex.get("path", "")), (options.directorymovie, plex.get("moviepath", "")))))
+    if config.has_section("xbmc") and config["xbmc"].get("host"):
+        xbmc = config["xbmc"]
+        servers.append(anidb.notify.Kodi(xbmc["host"], xbmc.get("port") or 8080, xbmc.get("user", ""), xbmc.get("password", ""),
+                                         ((options.directory, xbmc.get("path", "")), (options.directorymovie, xbmc.get("moviepath", "")))))
+    return anidb.notify.Notifier(servers, options.debounce) if servers else None
+
+def notify(force=False):
+    for server, path, error in notifier.flush(force):
+        if error:
+            print('{0} {1} ({2})'.format(red('Could not notify {0}:'.format(server.name)), path, error))
+        else:
+            print('{0} {1}'.format(green('Notified {0}:'.format(server.name)), path))
+
+def finish(file, target, status):
+    # A retried file leaves the deferred queue unless it was parked again.
+    if deferred is not None and getattr(file, 'deferred', None) and status not in ('unknown', 'deferred'):
+        deferred.remove(file.name)
+    if checkpoint:
+        # A file that could not be placed is tried again on resume.
+        if status != 'failed':
+            checkpoint.done(file, target, status)
+        progress.update(file.size)
+        print('{0} {1}'.format(blue('Progress:'), progress))
+
+def place(plan, directories):
+    # Every target directory is listed or created once (directories caches
+    # the names in it), so collisions show up without a stat per file.
+    global a
+    unknown = 0
+    sources = set()
+    for file, fid, info, target in plan:
+        status = 'done'
+        try:
+            if target != file.name:
+                parent = target.parent
+                try:
+                    if parent not in directories:
+                        try:
+                            directories[parent] = set(os.listdir(parent))
+                        except FileNotFoundError:
+                            parent.mkdir(parents=True, exist_ok=True)
+                            directories[parent] = set()
+                    if target.name in directories[parent]:
+                        print('{0} {1}'.format(red('Target exists, not moving:'), target))
+                        finish(file, file.name, 'collision')
+                        continue
+                    with stats.span('move', file.name, bytes=file.size) as span:
+                        span['mode'], span['copied'] = placer.place(file.name, target, file.size)
+                except OSError as e:
+                    # The source stays where it is, the run goes on with the next file.
+                    print('{0} {1}: {2}'.format(red('Could not place:'), target, e.strerror or e))
+                    finish(file, file.name, 'failed')
+                    unknown += 1
+                    continue
+                if span['mode'] != options.placement:
+                    print('{0} {1}'.format(yellow('Placed by:'), span['mode']))
+                directories[parent].add(target.name)
+                # Only a moved file leaves its folder empty.
+                if span['mode'] == 'move':
+                    sources.add(file.name.parent)
+                # Media servers only hear about folders that changed.
+                if notifier:
+                    notifier.touch(target.parent)
+
+            # Library index.
+
+            if index:
+                worse, better = index.versions(file, info)
+                for row in better:
+                    print('{0} {1}'.format(yellow('Better version in library:'), row['path']))
+                for row in worse:
+                    print('{0} {1}'.format(yellow('Upgrade of:'), row['path']))
+                    if options.replace:
+                        os.remove(row['path'])
+                        index.remove(row['size'], row['ed2k'])
+                        print('{0} {1}'.format(yellow('Removed:'), row['path']))
+                index.add(file, info, target)
+
+            # Adding. Without AniDB the placed file is parked to be added later.
+
+            if (options.add or options.watched) and a is None:
+                raise Offline(outage)
+
+            if options.add:
+                with stats.span('mylist', file.name, a) as span:
+                    span['sent'] = a.add_file(fid, viewed = options.watched, retry = deferred is None)
+                print(green('Added to mylist.') if span['sent'] else 'Already in mylist.')
+
+            # Watched.
+
+            elif options.watched:
+                with stats.span('mylist', file.name, a) as span:
+                    span['sent'] = a.add_file(fid, viewed = True, edit = True, retry = deferred is None)
+                print(green('Marked watched.') if span['sent'] else 'Already watched.')
+
+        except anidb.AniDBUnknownFile:
+            print(red('Unknown file.'))
+            status = 'unknown'
+            unknown += 1
+            park(file, 'unknown', target)
 
-def hashing():
+        except anidb.AniDBNotInMylist:
+            print(red('File not in mylist.'))
+
+        except anidb.AniDBUserError:
+            print(red('Invalid username/password.'))
+            sys.exit(0)
+
+        except (Offline, anidb.AniDBTimeout, anidb.AniDBUnavailable) as e:
+            reason = offline_reason(e)
+            print(yellow('AniDB unreachable, deferred.'))
+            if a is not None:
+                go_offline(reason)
+            status = 'deferred'
+            park(file, reason, target)
+
+        finish(file, target, status)
+
+    # Emptied source folders go in one pass, deepest first.
+    if options.delete:
+        for folder in sorted(sources, key=lambda p: len(p.parts), reverse=True):
+            if watch and folder in target_path:
+                continue
+            try:
+                folder.rmdir()
+            except OSError:
+                pass
+    return unknown
+
+def park(file, reason, path = None):
+    if deferred is not None:
+        delay = deferred.park(file, reason, path)
+        if delay:
+            print('{0} {1:.0f} min'.format(yellow('Retrying in:'), delay / 60))
+
+def hashing(files, stored = ()):
+    # stored: deferred files, their hashes come from the queue.
     hashed = unknown = 0
-    for file in anidb.hash.hash_files(files, options.cache, (('ed2k', 'md5', 'sha1', 'crc32') if options.multihash else ('ed2k',))):
-        print('{0} ed2k://|file|{1}|{2}|{3}|{4}'.format(blue('Hashed:'),  file.name, file.size, file.ed2k, ' (cached)' if file.cached else ''))
+    plan = []
+    directories = {}
+    failed = []
+    if prefetcher:
+        files = prefetching(files)
+    for file in chain(stored, anidb.hash.hash_files(files, options.cache, (('ed2k', 'md5', 'sha1', 'crc32') if options.multihash else ('ed2k',)), options.threads, options.blocksize, options.iomode,
+                                          make_file = make_file, policy = options.schedule, job = job_of, stats = stats, failed = failed)):
+        if getattr(file, 'deferred', None):
+            print('{0} ed2k://|file|{1}|{2}|{3}|'.format(blue('Retrying:'),  file.name, file.size, file.ed2k))
+        else:
+            print('{0} ed2k://|file|{1}|{2}|{3}|{4}'.format(blue('Hashed:'),  file.name, file.size, file.ed2k, ' (cached)' if file.cached else ''))
+            stats.record('hash', file.name, file.hashtime, bytes=file.size, cached=file.cached)
+            hashed += 1
         fid = (file.size, file.ed2k)
-        hashed += 1
 
         try:
 
@@ -112,265 +579,80 @@ def hashing():
                 print('{0} {1}'.format(blue('SHA1:'), file.sha1))
                 print('{0} {1}'.format(blue('CRC32:'), file.crc32))
 
+            # Exact copies already in the library are left alone.
+
+            if index:
+                row = index.duplicate(file)
+                if row:
+                    raise Duplicate(row['path'])
+
             # Identify.
 
+            if options.login and a is None:
+                raise Offline(outage)
+
+            info = tvdbinfo = None
             if options.identify:
-                info = a.get_file(fid, True)
-                fid = int(info['fid'])
+                with stats.span('identify', file.name, a):
+                    info = identify(fid)
+                fid = info.fid
 
-                if (info['english'] == ""): info['english'] = info['romaji']
+                if not info.english: info.english = info.romaji
 
-                print('{0} [{1}] {2} ({3}) - {4} - {5} ({6})'.format(green('Identified:'), info['gtag'], info['romaji'], info['english'], info['epno'], info['epromaji'], info['epname']))
+                print('{0} [{1}] {2} ({3}) - {4} - {5} ({6})'.format(green('Identified:'), info.gtag, info.romaji, info.english, info.epno, info.epromaji, info.epname))
 
             # get tvdb info
 
             if options.tvdb:
-                tvdbinfo = mytvdb.find_tvdb(info["aid"],info["epno"])
+                with stats.span('tvdb', file.name):
+                    tvdbinfo = tvdb_lookup(str(info.aid), info.epno)
                 if tvdbinfo:
-                    info.update(tvdbinfo)
-                    print('{0} {1} S{2} E{3} - {4}'.format(green('TvDB:'), info['tvdbseriesname'].encode('utf-8'), info['tvdbseason'], info['tvdbepnum'][0] if len(info['tvdbepnum']) == 1 else info['tvdbepnum'][0]+"-"+info['tvdbepnum'][len(info['tvdbepnum'])-1], info['tvdbepname'].encode('utf-8')))
+                    print('{0} {1} S{2} E{3} - {4}'.format(green('TvDB:'), tvdbinfo['tvdbseriesname'], tvdbinfo['tvdbseason'], tvdb_episodes(tvdbinfo), tvdbinfo['tvdbepname']))
                 else:
                     print(red('TVDB: ') + 'no match found!')
 
             # Renaming.
 
+            target = file.name
             if options.rename or options.move:
-                rename = config["rename"]
-
-                if options.rename:
-
-                    if options.tvdb and tvdbinfo:
-                        s = rename['tvdbepisodeformat']
-                    elif (info['type'] == 'Movie' and rename['movieformat']):
-                        s = rename['movieformat']
-                    elif (info['type'] == 'OVA' and rename['ovaformat']):
-                        s = rename['ovaformat']
-                    elif (rename['tvformat']):
-                        s = rename['tvformat']
-                    else:
-                        s = '%ATe% - %EpNo%%Ver% - %ETe% [%GTs%][%FCRC%]'
-
-                    rename_data = {
-                        #Anime title, r: romaji, e: english, k: kanji, s: synonym, o: other
-                        'ATr': info['romaji'],
-                        'ATe': info['english'],
-                        'ATk': info['kanji'],
-                        #'ATs': info['synonym'],
-                        #'ATo': info['other'],
-
-                        #Episode title, languages as above
-                        'ETr': info['epromaji'],
-                        'ETe': info['epname'],
-                        'ETk': info['epkanji'],
-
-                        #Group title, s: short, l: long
-                        'GTs':info['gtag'],
-                        'GTl':info['gname'],
-
-                        'EpHiNo': info['eptotal'], #Highest (subbed) episode number
-                        'EpCount': info['eptotal'], #Anime Episode count
-                        'AYearBegin': info['year'].split("-")[0],
-                        'AYearEnd':	 info['year'].split("-")[1] if (info['year'].find('-') > 0) else '', #The beginning & ending year of the anime
-                        #'ACatList': info['category'],
-
-                        'EpNo': info['epno'] if (len(info['epno']) > 1) else '0' + info['epno'], #File's Episode number
-
-                        'Type': info['type'], #Anime type, Value: 'Movie', 'TV', 'OVA', 'Web'
-                        'Depr': info['depr'], #File is deprecated if the value is '1'
-                        'Cen': {0:'',128:'censored'}[(int(info['state']) & 128)], #File is censored
-                        'Ver': {0: '', 4: 'v2', 8: 'v3', 16: 'v4', 32: 'v5'}[(int(info['state']) & 0x3c)], #File version
-                        'Source': info['source'], #Where the file came from (HDTV, DTV, WWW, etc)
-                        'Quality': info['quality'], #How good the quality of the file is (Very Good, Good, Eye Cancer)
-                        #'AniDBFN': info['anifilename'], #Default AniDB filename
-                        'CurrentFN': file.name.name, #Current Filename
-                        'FCrc' : info['crc32'],#The file's crc
-                        'FCRC': info['crc32'].upper(),
-                        'FVideoRes': info['vres'], #Video Resolution (e.g. 1920x1080)
-                        'FALng': info['dublang'], #List of available audio languages (japanese, english'japanese'german)
-                        'FSLng': info['sublang'], #List of available subtitle languages (japanese, english'japanese'german)
-                        'FACodec': info['acodec'], #Codecs used for the Audiostreams
-                        'FVCodec': info['vcodec'], #Codecs used for the Videostreams
-                        'suf': info['filetype'],
-                    }
-
-                    if options.tvdb and tvdbinfo:
-                        rename_data.update({	
-                            #tvdb
-                            'TSTe': info['tvdbseriesname'],
-                            'TETe': info['tvdbepname'],
-                            'TS': info['tvdbseason'],
-                            'TE': info['tvdbepnum'][0] if len(info['tvdbepnum']) == 1 else info['tvdbepnum'][0]+"-"+info['tvdbepnum'][len(info['tvdbepnum'])-1],
-                            'TSE': 'S'+info['tvdbseason']+'E'+info['tvdbepnum'][0] if len(info['tvdbepnum']) == 1 else 'S'+info['tvdbseason']+'E'+info['tvdbepnum'][0]+"-E"+info['tvdbepnum'][len(info['tvdbepnum'])-1],
-                        })
-
-                    # parse s to replace tags
-                    #for name, value in rename.items():
-                    #	s = s.replace(r'%' + name + r'%', value)
-
-                    for name, value in rename_data.items():
-                        s = s.replace(r'%' + name + r'%', value)
-
-                    s = s + '.' + rename_data['suf']
-
-                    # change spaces to underscores, if first character in s is an underscore
-                    if s[0] == '_':
-                        s = s[1:].replace(' ', '_')
-
-                if options.move:
-
-                    if options.tvdb and tvdbinfo:
-                        f = rename['tvdbfoldername']
-                        if int(info['tvdbseason']) > 0:
-                            fs = rename['tvdbseasonfolder']
-                        else:
-                            fs = rename['tvdbspecialsfolder']
-                    elif (info['type'] == "Movie" and rename['foldernamemovie']):
-                        f = rename['foldernamemovie']
-                        fs = None
-                    elif (rename['foldername']):
-                        f = rename['foldername']
-                        fs = None
-                    else:
-                        f = '%ATe%'
-                        fs = None
-
-                    move_data = {
-                        #Anime title, r: romaji, e: english, k: kanji, s: synonym, o: other
-                        'ATr': info['romaji'],
-                        'ATe': info['english'],
-                        'ATk': info['kanji'],
-                        #'ATs': info['synonym'],
-                        #'ATo': info['other'],
-
-                        #Group title, s: short, l: long
-                        'GTs':info['gtag'],
-                        'GTl':info['gname'],
-
-                        'EpHiNo': info['eptotal'], #Highest (subbed) episode number
-                        'EpCount': info['eptotal'], #Anime Episode count
-                        'AYearBegin': info['year'].split("-")[0],
-                        'AYearEnd':	 info['year'].split("-")[1] if (info['year'].find('-') > 0) else '', #The beginning & ending year of the anime
-                        #'ACatList': info['category'],
-
-                        'Type': info['type'], #Anime type, Value: 'Movie', 'TV', 'OVA', 'Web'
-                        'Source': info['source'], #Where the file came from (HDTV, DTV, WWW, etc)
-                        'Quality': info['quality'], #How good the quality of the file is (Very Good, Good, Eye Cancer)
-                        'FVideoRes': info['vres'], #Video Resolution (e.g. 1920x1080)
-                        'FALng': info['dublang'], #List of available audio languages (japanese, english'japanese'german)
-                        'FSLng': info['sublang'], #List of available subtitle languages (japanese, english'japanese'german)
-                        'FACodec': info['acodec'], #Codecs used for the Audiostreams
-                        'FVCodec': info['vcodec'], #Codecs used for the Videostreams
-                        'suf': info['filetype']}
-
-                    if options.tvdb and tvdbinfo:
-                        move_data.update({	
-                            #tvdb
-                            'TSTe': info['tvdbseriesname'],
-                            'TETe': info['tvdbepname'],
-                            'TS': info['tvdbseason'],
-                            'TE': info['tvdbepnum'][0] if len(info['tvdbepnum']) == 1 else info['tvdbepnum'][0]+"-"+info['tvdbepnum'][len(info['tvdbepnum'])-1],
-                            'TSE': 'S'+info['tvdbseason']+'E'+info['tvdbepnum'][0] if len(info['tvdbepnum']) == 1 else 'S'+info['tvdbseason']+'E'+info['tvdbepnum'][0]+"-E"+info['tvdbepnum'][len(info['tvdbepnum'])-1],
-                        })
-
-                    # parse f to replace tags
-                    #for name, value in rename.items():
-                    #	f = f.replace(r'%' + name + r'%', value)
-
-                    for name, value in move_data.items():
-                        f = f.replace(r'%' + name + r'%', value)
-
-                    if fs:
-                        for name, value in move_data.items():
-                            fs = fs.replace(r'%' + name + r'%', value)
-
-                    # change spaces to underscores, if first character in s is an underscore
-                    if f[0] == '_':
-                        f = f[1:].replace(' ', '_')
-                    if fs and fs[0] == '_':
-                        fs = fs[1:].replace(' ', '_')
-
-                #do the rename and move
-
-                filename = file.name.name
-
-                if options.rename:
-                    filename = remove_disallowed_filename_chars(s)
-
-                    while filename.startswith('.'):
-                        filename = filename[1:]
-                    print('{0} {1}'.format(yellow('Renaming to:'), filename))
-
-                    path = file.name.parent
-
-                if options.move:
-                    subdir = remove_disallowed_filename_chars(f)
-                    while subdir.startswith('.'):
-                        subdir = subdir[1:]
-
-                    if (options.directorymovie and info['type'] == 'Movie'):
-                        target_directory = options.directorymovie
-                    else:
-                        target_directory = options.directory
-
-                    basedir = target_directory / subdir
-                    
-                    if not basedir.exists():
-                        basedir.mkdir(parents=True, exist_ok=True)
-
-                    if fs:
-                        seasondir = remove_disallowed_filename_chars(fs)
-                        while seasondir.startswith('.'):
-                            seasondir = seasondir[1:]
-                        subdir = subdir / seasondir
+                target = plan_target(file, info, tvdbinfo)
 
-                    path = target_directory / subdir
+            plan.append((file, fid, info, target))
 
-                    print('{0} {1}'.format(yellow('Moving to:'), path))
-                    if (not path.exists()):
-                        path.mkdir()
-                        #oldumask = os.umask(000)
-                        #os.makedirs(path)
-                        #os.umask(oldumask)
-
-
-                target = path / filename
-                #failsave against long filenames
-                #if len(target) > 255:
-                #    target = target[:250].strip() + target[-4:]
-
-                shutil.move(file.name, target)
-
-            if options.delete:
-                delete_folder = True
-                folder = file.name.parent
-                for sub in folder.iterdir():
-                    if sub.exists():
-                        #don't delete
-                        delete_folder = False
+        except anidb.AniDBUnknownFile:
+            print(red('Unknown file.'))
+            park(file, 'unknown')
+            finish(file, file.name, 'unknown')
+            unknown += 1
 
-                if delete_folder:
-                    folder.rmdir()
+        except Offline as e:
+            print(yellow('AniDB unreachable, deferred.'))
+            park(file, e.reason)
+            finish(file, file.name, 'deferred')
 
+        except anidb.AniDBUserError:
+            print(red('Invalid username/password.'))
+            sys.exit(0)
 
-            # Adding.
+        except (OSError, anidb.AniDBError) as e:
+            # TVDB unreachable or an odd AniDB reply, for this file only.
+            print('{0} {1}'.format(red('Lookup failed:'), e))
+            park(file, 'timeout')
+            finish(file, file.name, 'deferred' if deferred is not None else 'failed')
+            unknown += 1
 
-            if options.add:
-                a.add_file(fid, viewed = options.watched, retry = True)
-                print(green('Added to mylist.'))
+        except Duplicate as e:
+            print('{0} {1}'.format(yellow('Duplicate of:'), e))
+            finish(file, file.name, 'duplicate')
 
-            # Watched.
+        # Moves are applied in batches of planned files.
+        if len(plan) >= options.batch:
+            unknown += place(plan, directories)
+            plan = []
 
-            elif options.watched:
-                a.add_file(fid, viewed = True, edit = True, retry = True)
-                print(green('Marked watched.'))
-
-        except anidb.AniDBUnknownFile:
-            print(red('Unknown file.'))
-            unknown += 1
-
-        except anidb.AniDBNotInMylist:
-            print(red('File not in mylist.'))
-    return hashed, unknown
+    unknown += place(plan, directories)
+    # Files that could not be read fail the run like unknown ones.
+    return hashed, unknown + len(failed)
 
 if __name__ == "__main__":
     config = {}
@@ -381,13 +663,34 @@ if __name__ == "__main__":
     except:
         pass
 
-    target_path = list(map(Path, args[1:]))
+    # --bulk walks whole libraries and resumes from its checkpoint, --restart drops the checkpoint.
+    # --watch keeps running and processes files dropped into the given folders.
+    # --retry tries every deferred file now instead of when its backoff ends.
+    bulk = '--bulk' in args
+    restart = '--restart' in args
+    watch = '--watch' in args
+    retry = '--retry' in args
+    target_path = [Path(p) for p in args[1:] if p not in ('--bulk', '--restart', '--watch', '--retry')]
 
     if not all(p.exists() for p in target_path):
         print('Destination directory does not exist')
         sys.exit(1)
     
     options = Options(config)
+    stats = anidb.stats.Stats(options.statslog or None)
+
+    # Profiling, dumped on exit so runs ending in sys.exit are covered too.
+    if options.profile:
+        import atexit, anidb.profiling, anidb.hash
+        profiler = anidb.profiling.Profiler(options.profiledir, options.tracemalloc)
+        profiler.mark(anidb.hash.Hash, "__init__", "Hash.__init__")
+        profiler.mark(anidb.AniDB, "execute")
+        if options.tvdb:
+            import tvdb
+            profiler.mark(tvdb.TvDB, "find_tvdb")
+        render = profiler.wrap(render, "render")
+        atexit.register(lambda: print('{0} {1}'.format(blue('Profile written:'), ', '.join(profiler.stop()))))
+        profiler.start()
     
     # Colors.
     if options.color:
@@ -402,95 +705,169 @@ if __name__ == "__main__":
         blue   = lambda x: x
     
     # Defaults.
+    options.identify = options.identify or options.rename or options.move or options.tvdb or options.index
+    options.login = options.add or options.watched or options.identify
+
+    if not options.directory and options.move:
+        print(red('No target directory.'))
+        sys.exit(1)
+
+    if not options.move and options.delete:
+        print(red('Can\'t delete folder without moving files.'))
+        sys.exit(1)
+
+    if options.schedule not in ('fifo', 'smallest', 'newest', 'fair'):
+        print(red('Unknown schedule: {0}'.format(options.schedule)))
+        sys.exit(1)
+
+    if options.placement not in ('move', 'reflink', 'hardlink', 'symlink', 'copy'):
+        print(red('Unknown placement: {0}'.format(options.placement)))
+        sys.exit(1)
+
+    # Empty and duplicate callbacks end here, before any subsystem is set up.
+    files = [] if watch or retry and not target_path else get_files(target_path)
+
+    checkpoint = progress = None
+    if bulk:
+        import anidb.bulk
+        checkpoint = anidb.bulk.Checkpoint(options.database, target_path)
+        if restart:
+            checkpoint.clear()
+        files = list(files)
+        pending = list(checkpoint.pending(files))
+        progress = anidb.bulk.Progress(len(pending), sum(size for name, size in pending), len(files) - len(pending))
+        print('{0} {1} files, {2} done earlier'.format(blue('Bulk run:'), len(files), len(files) - len(pending)))
+        files = [name for name, size in pending]
+
+    import anidb.hash
+    if options.iomode not in anidb.hash.io_modes:
+        print(red('Unknown iomode: {0}'.format(options.iomode)))
+        sys.exit(1)
+    anidb.hash.limit(options.ratelimit * 1e6)
+
     if options.cache:
         try:
             import xattr
         except ImportError:
             print(red('No xattr, caching disabled.'))
             options.cache = False
-    options.identify = options.identify or options.rename or options.move or options.tvdb
-    options.login = options.add or options.watched or options.identify
 
     if options.login:
         if not options.username:
             options.username = input('Username: ')
         if not options.password:
+            import getpass
             options.password = getpass.getpass()
 
-    if not options.directory and options.move:
-        print(red('No target directory.'))
-        sys.exit(1)
-
-    if not options.move and options.delete:
-        print(red('Can\'t delete folder without moving files.'))
-        sys.exit(1)
-
-    if options.tvdb:
-        animelistfile = Path(__file__).parent / "anime-list.xml"
-        mytvdb = tvdb.TvDB(animelistfile)
-
-    files = get_files(target_path)
-
+    # Files on storage owned by a hashing worker are hashed there.
+    make_file = anidb.hash.File
+    if config.has_section("workers") and config["workers"]:
+        import anidb.worker
+        make_file = anidb.worker.Dispatcher.from_config(config["workers"])
+
+    index = None
+    if options.index:
+        import anidb.index
+        index = anidb.index.LibraryIndex(options.database)
+
+    # Constructed on first use, may download and parse the mapping.
+    mytvdb = None
+    tvdb_lock = threading.Lock()
+    tvdb_results = {}
+    fields = file_fields()
+
+    # Files AniDB could not identify yet, retried later without hashing them again.
+    deferred = None
+    if options.defer and options.login:
+        import anidb.deferred
+        deferred = anidb.deferred.Deferred(options.database)
+
+    # While AniDB is unreachable or has banned us, no login before relogin.
+    a = None
+    relogin = 0
+    outage = 'timeout'
     if options.login:
         a = login()
-    
-    hashed, unknown = hashing()
-    
-    # notify PlexMediaServer
-
-    if options.update and hashed > 0 and hashed > unknown:
 
-        plex = {}
+    # TVDB mappings guessed from the file names are looked up while hashing.
+    prefetcher = None
+    if options.prefetch and options.tvdb:
+        import anidb.titles
+        titles = anidb.titles.Titles(options.database)
+        if len(titles):
+            from concurrent.futures import ThreadPoolExecutor
+            prefetcher = ThreadPoolExecutor(1)
+
+    # Files are moved, or linked into the library and kept for seeding.
+    import anidb.place
+    placer = anidb.place.Placer(options.placement)
+
+    # Media servers get one path-scoped refresh per touched directory.
+    notifier = get_notifier() if options.update else None
+    
+    if watch:
+        import anidb.watch
+        # Files already in the folders are picked up like new ones.
+        watcher = anidb.watch.Watcher(target_path, options.settle, scan = True)
+        # Woken up for the media server refresh, for deferred files and,
+        # while AniDB is unreachable, to log in again once relogin is reached.
+        def wakeup():
+            times = []
+            if notifier:
+                times.append(notifier.remaining())
+            if deferred is not None:
+                times.append(deferred.remaining() if a else max(relogin - time.time(), 0))
+            return min([t for t in times if t is not None], default = None)
+        print('{0} {1}'.format(blue('Watching:'), ', '.join(map(str, target_path))))
         try:
-            cp = ConfigParser.ConfigParser()
-            cp.read(os.path.join(os.path.dirname(sys.argv[0]), "..", "anidb.cfg"))
-            for option in cp.options('plex'):
-                plex[option] = cp.get('plex', option)
-
-            if (plex['host'] != ""):
-                if (plex["sections"] == ""):
-                    plex["sections"] = "all"
-
-                for section in plex["sections"].split(","):
-                    req = "http://"+plex["host"]+":32400/library/sections/"+section+"/refresh"
+            for batch in watcher.batches(wakeup):
+                batch = list(watched_files(batch))
+                if options.login and a is None and time.time() >= relogin:
+                    a = login()
+                stored = due()
+                if batch or stored:
                     try:
-                        urllib.urlopen(req)
-                    except urllib.HTTPError as e:
-                        print(red('Could not notify Plex Media Server'))
-                        print(e.code)
+                        hashed, unknown = hashing(batch, stored)
+                    except Exception as e:
+                        # One failed batch does not end the watcher: its new files
+                        # settle again in ten minutes, deferred ones are parked again.
+                        print('{0} {1}: {2}'.format(red('Batch failed:'), type(e).__name__, e))
+                        watcher.requeue([p for p in batch if p.exists()], 600)
+                        for file in stored:
+                            if file.name in deferred:
+                                park(file, file.deferred)
                     else:
-                        print(green('Notified Plex Media Server'))
-        except:
-            pass
-        
-    # notify XBMC
-
-    if options.update and hashed > 0 and hashed > unknown:
-        xbmc = {}
-        try:
-            cp = ConfigParser.ConfigParser()
-            cp.read(os.path.join(os.path.dirname(sys.argv[0]), "..", "anidb.cfg"))
-            for option in cp.options('xbmc'):
-                xbmc[option] = cp.get('xbmc', option)
-
-            if (xbmc['host'] != ""):
-                if (xbmc['path'] != "" and hashed == 1):
-                    updateCommand = '{"jsonrpc":"2.0","method":"VideoLibrary.Scan","params":{"directory":%s},"id":1}' % json.dumps(xbmc['path'] + f + '/')
-                    req = 'http://'+xbmc['user']+':'+xbmc['password']+'@'+xbmc['host']+':'+xbmc['port']+'/jsonrpc?request='+urllib.quote(updateCommand,'')
-                else:
-                    req = "http://"+xbmc["user"]+":"+xbmc["password"]+"@"+xbmc["host"]+":"+xbmc["port"]+"/jsonrpc?request={\"jsonrpc\":\"2.0\",\"method\":\"VideoLibrary.Scan\"}"
-                try:
-                    urllib.urlopen(req)
-                except urllib.HTTPError as e:
-                    print(red('Could not notify XBMC'))
-                    print(e.code)
-                else:
-                    print(green('Notified XBMC'))
-        except:
-            pass
+                        print(blue('Hashed {0} files{1}.'.format(hashed, ', {0} unknown'.format(unknown) if unknown else '')))
+                if notifier:
+                    notify()
+        except KeyboardInterrupt:
+            watcher.close()
+            if prefetcher:
+                prefetcher.shutdown(cancel_futures = True)
+            if notifier:
+                notify(True)
+            sys.exit(0)
+
+    hashed, unknown = hashing(files, due())
+    if prefetcher:
+        prefetcher.shutdown(cancel_futures = True)
     
+    # Refresh the media servers.
+    if notifier:
+        notify(True)
+        notifier.close()
+
     # Finished.
     print(blue('Hashed {0} files{1}.'.format(hashed, ', {0} unknown'.format(unknown) if unknown else '')))
+    if placer.report():
+        print(blue('Placed: {0}.'.format(placer.report())))
+    if deferred is not None and len(deferred):
+        print(yellow('{0} files in the deferred queue.'.format(len(deferred))))
+    if options.stats:
+        print(stats.summary())
+    if options.promfile:
+        stats.write_prometheus(options.promfile)
+    stats.close()
     if (unknown > 0):
         sys.exit(1)
         
\ No newline at end of file